@@ -0,0 +1,366 @@
+"""
+Локальные заглушки Telegram Bot API и Gemini для нагрузочных тестов.
+
+FakeTelegramServer — HTTP (aiohttp), понимает методы, которые вызывает бот,
+и отдаёт файлы фото. FakeGeminiServer — gRPC GenerativeService (v1beta)
+с обычной и потоковой генерацией и CacheService для кэша промтов. У обоих
+настраиваются задержки и доля ответов 429.
+"""
+
+import asyncio
+import random
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Dict, Optional
+
+import grpc
+from aiohttp import web
+from google.protobuf import empty_pb2
+from PIL import Image
+
+import google.ai.generativelanguage as glm
+
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "MedBot", "username": "medbot_fake"}
+
+ANSWER_TEXT = (
+    "📌 **Исследование:** Рандомизированное контролируемое исследование\n"
+    "   Год: 2023 | Авторы: Иванов И.И. и др.\n"
+    "   Результат: снижение риска, RR 0.78 (95% CI 0.65–0.93)\n"
+    "   GRADE: Moderate\n"
+    "   PMID: 12345678\n\n"
+)
+
+def _jittered(mean: float, jitter: float) -> float:
+    return max(0.0, random.uniform(mean - jitter, mean + jitter))
+
+def make_jpeg(width: int, height: int) -> bytes:
+    """Тестовое фото заданного размера."""
+    image = Image.new("RGB", (width, height), (180, 120, 110))
+    out = BytesIO()
+    image.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+# ═══════════════════════════════════════════════════════════════
+# 📨 TELEGRAM
+# ═══════════════════════════════════════════════════════════════
+
+class FakeTelegramServer:
+    """Заглушка Bot API: /bot{token}/{method} и /file/bot{token}/{path}."""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, rate_limit_share: float = 0.0,
+                 retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.files: Dict[str, bytes] = {}
+        self._message_ids = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def add_photo(self, file_id: str, width: int, height: int) -> int:
+        """Регистрирует файл фото; возвращает его размер в байтах."""
+        data = make_jpeg(width, height)
+        self.files[file_id] = data
+        return len(data)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        await asyncio.sleep(_jittered(self.latency, self.jitter))
+
+        if method in ("sendMessage", "editMessageText") and random.random() < self.rate_limit_share:
+            self.rate_limited[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: Dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            if method == "sendMessage":
+                self._message_ids += 1
+                message_id = self._message_ids
+            else:
+                message_id = int(params.get("message_id", 0))
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        self.calls["downloadFile"] += 1
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        data = self.files.get(file_id)
+        if data is None:
+            raise web.HTTPNotFound()
+        await asyncio.sleep(_jittered(self.latency, self.jitter) + len(data) / (20 * 1024 * 1024))
+        return web.Response(body=data, content_type="image/jpeg")
+
+# ═══════════════════════════════════════════════════════════════
+# 🤖 GEMINI
+# ═══════════════════════════════════════════════════════════════
+
+GENERATIVE_SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+CACHE_SERVICE = "google.ai.generativelanguage.v1beta.CacheService"
+
+class FakeGeminiServer:
+    """
+    Заглушка GenerativeService и CacheService по gRPC без TLS.
+    Ключ берётся из метаданных x-goog-api-key (бот с GEMINI_API_INSECURE=1 их передаёт).
+    Системный промт инлайн добавляет prefill_per_kchar секунд на каждую 1000 символов,
+    из кэша — нет. Кэш меньше cache_min_chars или для cache_unsupported моделей отклоняется.
+    rpm_limit — настоящий минутный лимит на пару модель×ключ (скользящее окно).
+    slow_share — доля «зависающих» вызовов, которые отвечают в slow_factor раз медленнее.
+    unavailable_share — доля ответов 503 (временная ошибка).
+    """
+
+    def __init__(self, latency: float = 1.0, jitter: float = 0.3, first_chunk: float = 0.3,
+                 chunks: int = 6, answer_repeats: int = 4, quota_share: float = 0.0,
+                 prefill_per_kchar: float = 0.0, cache_min_chars: int = 0, cache_unsupported=(),
+                 rpm_limit: int = 0, slow_share: float = 0.0, slow_factor: float = 10.0,
+                 unavailable_share: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.first_chunk = first_chunk
+        self.chunks = chunks
+        self.answer_repeats = answer_repeats
+        self.quota_share = quota_share
+        self.prefill_per_kchar = prefill_per_kchar
+        self.cache_min_chars = cache_min_chars
+        self.cache_unsupported = set(cache_unsupported)
+        self.rpm_limit = rpm_limit
+        self.slow_share = slow_share
+        self.slow_factor = slow_factor
+        self.slow_calls = 0
+        self.unavailable_share = unavailable_share
+        self.unavailable_errors = 0
+        self._windows: Dict[tuple, deque] = {}
+        self.calls = Counter()
+        self.quota_errors = Counter()
+        self.cache_calls = Counter()
+        # {name: (ключ, модель, текст промта, время истечения)}
+        self.caches: Dict[str, tuple] = {}
+        self._cache_ids = 0
+        self._server: Optional[grpc.aio.Server] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = grpc.aio.server()
+        self._server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(GENERATIVE_SERVICE, {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                self._generate,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                self._stream_generate,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        }), grpc.method_handlers_generic_handler(CACHE_SERVICE, {
+            "CreateCachedContent": grpc.unary_unary_rpc_method_handler(
+                self._create_cache,
+                request_deserializer=glm.CreateCachedContentRequest.deserialize,
+                response_serializer=glm.CachedContent.serialize,
+            ),
+            "GetCachedContent": grpc.unary_unary_rpc_method_handler(
+                self._get_cache,
+                request_deserializer=glm.GetCachedContentRequest.deserialize,
+                response_serializer=glm.CachedContent.serialize,
+            ),
+            "UpdateCachedContent": grpc.unary_unary_rpc_method_handler(
+                self._update_cache,
+                request_deserializer=glm.UpdateCachedContentRequest.deserialize,
+                response_serializer=glm.CachedContent.serialize,
+            ),
+            "DeleteCachedContent": grpc.unary_unary_rpc_method_handler(
+                self._delete_cache,
+                request_deserializer=glm.DeleteCachedContentRequest.deserialize,
+                response_serializer=empty_pb2.Empty.SerializeToString,
+            ),
+        })])
+        port = self._server.add_insecure_port(f"{host}:{port}")
+        await self._server.start()
+        return f"{host}:{port}"
+
+    async def stop(self):
+        if self._server is not None:
+            await self._server.stop(grace=None)
+
+    def _slowdown(self) -> float:
+        if random.random() < self.slow_share:
+            self.slow_calls += 1
+            return self.slow_factor
+        return 1.0
+
+    async def _admit(self, request: glm.GenerateContentRequest, context) -> str:
+        """Учитывает вызов; с вероятностью quota_share отвечает 429."""
+        api_key = self._api_key(context)
+        if api_key == "?":
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, "API key not valid. Please pass a valid API key.")
+        model = request.model.split("/")[-1]
+        self.calls[(model, api_key)] += 1
+        if self.rpm_limit:
+            window = self._windows.setdefault((model, api_key), deque())
+            now = time.monotonic()
+            while window and now - window[0] > 60:
+                window.popleft()
+            if len(window) >= self.rpm_limit:
+                self.quota_errors[(model, api_key)] += 1
+                await context.abort(
+                    grpc.StatusCode.RESOURCE_EXHAUSTED,
+                    "Quota exceeded for metric: GenerateRequestsPerMinutePerProjectPerModel-FreeTier."
+                )
+            window.append(now)
+        if random.random() < self.unavailable_share:
+            self.unavailable_errors += 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "The model is overloaded. Please try again later.")
+        if random.random() < self.quota_share:
+            self.quota_errors[(model, api_key)] += 1
+            await context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED,
+                "Quota exceeded for metric: GenerateRequestsPerMinutePerProjectPerModel-FreeTier. "
+                "Please retry in 7s."
+            )
+        return model
+
+    @staticmethod
+    def _api_key(context) -> str:
+        return dict(context.invocation_metadata()).get("x-goog-api-key", "?")
+
+    async def _prefill(self, request: glm.GenerateContentRequest, context) -> int:
+        """Задержка на инлайн-промт; возвращает длину промта из кэша (для usage)."""
+        if request.cached_content:
+            cache = self.caches.get(request.cached_content)
+            if cache is None or cache[0] != self._api_key(context) or cache[3] < time.time():
+                await context.abort(grpc.StatusCode.NOT_FOUND, "CachedContent not found (or permission denied)")
+            return len(cache[2])
+        system_chars = sum(len(part.text) for part in request.system_instruction.parts)
+        await asyncio.sleep(self.prefill_per_kchar * system_chars / 1000)
+        return 0
+
+    def _usage(self, request: glm.GenerateContentRequest, text: str, cached_chars: int):
+        prompt_chars = sum(len(part.text) for content in request.contents for part in content.parts)
+        prompt_chars += sum(len(part.text) for part in request.system_instruction.parts)
+        return glm.GenerateContentResponse.UsageMetadata(
+            prompt_token_count=(prompt_chars + cached_chars) // 3 + 1,
+            cached_content_token_count=cached_chars // 3,
+            candidates_token_count=len(text) // 3 + 1,
+        )
+
+    def _response(self, text: str, finish: bool, usage=None) -> glm.GenerateContentResponse:
+        candidate = glm.Candidate(
+            index=0,
+            content=glm.Content(role="model", parts=[glm.Part(text=text)]),
+            finish_reason=glm.Candidate.FinishReason.STOP if finish else glm.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+        )
+        return glm.GenerateContentResponse(candidates=[candidate], usage_metadata=usage)
+
+    def _answer(self, model: str) -> str:
+        return f"Ответ модели {model}.\n\n" + ANSWER_TEXT * self.answer_repeats
+
+    async def _generate(self, request: glm.GenerateContentRequest, context) -> glm.GenerateContentResponse:
+        model = await self._admit(request, context)
+        cached_chars = await self._prefill(request, context)
+        await asyncio.sleep(_jittered(self.latency, self.jitter) * self._slowdown())
+        text = self._answer(model)
+        return self._response(text, True, self._usage(request, text, cached_chars))
+
+    async def _stream_generate(self, request: glm.GenerateContentRequest, context):
+        model = await self._admit(request, context)
+        cached_chars = await self._prefill(request, context)
+        text = self._answer(model)
+        await asyncio.sleep(_jittered(self.first_chunk, self.jitter / 2) * self._slowdown())
+        step = max(1, len(text) // self.chunks + 1)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        pause = max(0.0, self.latency - self.first_chunk) / max(1, len(pieces) - 1)
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(pause)
+            last = i == len(pieces) - 1
+            yield self._response(piece, last, self._usage(request, text, cached_chars) if last else None)
+
+    # ── CacheService ──
+
+    def _cache_message(self, name: str) -> glm.CachedContent:
+        _, model, _, expires = self.caches[name]
+        return glm.CachedContent(
+            name=name, model=f"models/{model}",
+            expire_time=datetime.fromtimestamp(expires, timezone.utc),
+        )
+
+    async def _create_cache(self, request: glm.CreateCachedContentRequest, context) -> glm.CachedContent:
+        self.cache_calls["create"] += 1
+        cached = request.cached_content
+        model = cached.model.split("/")[-1]
+        text = "".join(part.text for part in cached.system_instruction.parts)
+        if model in self.cache_unsupported:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Model {model} does not support cached content")
+        if len(text) < self.cache_min_chars:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Cached content is too small. total_token_count={len(text) // 3}, "
+                f"min_total_token_count={self.cache_min_chars // 3}"
+            )
+        self._cache_ids += 1
+        name = f"cachedContents/fake{self._cache_ids}"
+        self.caches[name] = (self._api_key(context), model, text, time.time() + cached.ttl.total_seconds())
+        return self._cache_message(name)
+
+    async def _get_cache(self, request: glm.GetCachedContentRequest, context) -> glm.CachedContent:
+        self.cache_calls["get"] += 1
+        if request.name not in self.caches:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"{request.name} not found")
+        return self._cache_message(request.name)
+
+    async def _update_cache(self, request: glm.UpdateCachedContentRequest, context) -> glm.CachedContent:
+        self.cache_calls["update"] += 1
+        name = request.cached_content.name
+        if name not in self.caches or self.caches[name][3] < time.time():
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"{name} not found")
+        key, model, text, _ = self.caches[name]
+        self.caches[name] = (key, model, text, time.time() + request.cached_content.ttl.total_seconds())
+        return self._cache_message(name)
+
+    async def _delete_cache(self, request: glm.DeleteCachedContentRequest, context):
+        self.cache_calls["delete"] += 1
+        self.caches.pop(request.name, None)
+        return empty_pb2.Empty()
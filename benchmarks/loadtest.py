@@ -0,0 +1,295 @@
+"""
+Нагрузочный тест бота без настоящих Telegram и Gemini.
+
+Поднимает FakeTelegramServer и FakeGeminiServer, направляет на них бота
+(TELEGRAM_API_BASE, GEMINI_API_ENDPOINT) и прогоняет синтетические апдейты
+из лички и групп через настоящий dp — так же, как их подаёт webhook.
+
+Запуск:
+    python benchmarks/loadtest.py --updates 500 --rate 50 --users 200
+    python benchmarks/loadtest.py --gemini-429 0.1 --telegram-429 0.05 --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import BOT_USER, FakeGeminiServer, FakeTelegramServer
+
+FAKE_TOKEN = "123456:FAKE-benchmark-token"
+
+QUESTIONS = [
+    "Какая эффективность метформина при гестационном диабете?",
+    "Нужна ли антибиотикопрофилактика при кесаревом сечении?",
+    "Аспирин для профилактики преэклампсии: с какого срока?",
+    "Что известно о прогестероне при угрозе преждевременных родов?",
+    "Первая линия терапии при артериальной гипертензии у пожилых?",
+    "Статины для первичной профилактики после 75 лет?",
+    "Длительность двойной антитромбоцитарной терапии после стентирования?",
+    "ВПЧ-вакцинация после конизации: есть ли польза?",
+]
+
+def rss_mb() -> float:
+    """Пиковый RSS процесса (ru_maxrss в КБ на Linux)."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class TrafficGenerator:
+    """Синтетические апдейты: личка и группы, текст и фото, адресованные и фоновые."""
+
+    def __init__(self, args, telegram: FakeTelegramServer):
+        self.args = args
+        self.telegram = telegram
+        self.update_id = 0
+        self.message_id = 0
+        self.groups = [-(1000000 + i) for i in range(max(1, args.groups))]
+        self.photo_ids: List[List[Dict]] = []
+        for i in range(args.photo_variants):
+            file_id = f"photo{i}"
+            # Как у Telegram: несколько размеров, file_id у каждого свой
+            sizes = []
+            for side in (320, 800, 1280, 2560):
+                size_id = f"{file_id}_{side}"
+                size = telegram.add_photo(size_id, side, side * 3 // 4)
+                sizes.append({
+                    "file_id": size_id, "file_unique_id": size_id,
+                    "width": side, "height": side * 3 // 4, "file_size": size,
+                })
+            self.photo_ids.append(sizes)
+
+    def next_update(self) -> Dict:
+        self.update_id += 1
+        self.message_id += 1
+        user_id = random.randint(1, self.args.users)
+        in_group = random.random() < self.args.group_share
+        chat = (
+            {"id": random.choice(self.groups), "type": "group", "title": "Ординаторская"}
+            if in_group else
+            {"id": user_id, "type": "private", "first_name": f"user{user_id}"}
+        )
+        question = random.choice(QUESTIONS)
+        if random.random() >= self.args.repeat_share:
+            # Уникальный вопрос — мимо кэша ответов
+            question = f"{question} Пациент {self.update_id}, {random.randint(18, 80)} лет."
+        if in_group:
+            if random.random() < self.args.addressed_share:
+                question = f"@{BOT_USER['username']} {question}"
+            else:
+                question = "Коллеги, кто сегодня дежурит?"
+
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if self.photo_ids and random.random() < self.args.photo_share:
+            message["photo"] = random.choice(self.photo_ids)
+            message["caption"] = question
+        else:
+            message["text"] = question
+        return {"update_id": self.update_id, "message": message}
+
+async def wait_drained(bot_main, feed_tasks: set, timeout: float) -> bool:
+    """Ждёт, пока опустеют задачи dp, склейка и очередь к модели."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        idle = (
+            not feed_tasks
+            and not bot_main.coalescer.pending
+            and not bot_main.coalescer.timers
+            and bot_main.scheduler.queued == 0
+            and bot_main.scheduler.running == 0
+        )
+        if idle:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+async def run(args) -> Dict:
+    telegram = FakeTelegramServer(
+        latency=args.telegram_latency, jitter=args.telegram_latency / 2,
+        rate_limit_share=args.telegram_429,
+    )
+    gemini = FakeGeminiServer(
+        latency=args.gemini_latency, jitter=args.gemini_latency / 3,
+        first_chunk=args.gemini_first_chunk, chunks=args.gemini_chunks,
+        quota_share=args.gemini_429, prefill_per_kchar=args.gemini_prefill,
+        cache_min_chars=args.gemini_cache_min_chars, rpm_limit=args.gemini_rpm,
+        slow_share=args.gemini_slow_share, slow_factor=args.gemini_slow_factor,
+        unavailable_share=args.gemini_503,
+    )
+    telegram_base = await telegram.start()
+    gemini_endpoint = await gemini.start()
+
+    # Конфигурация бота читается при импорте — окружение задаём до него
+    os.environ.update({
+        "TELEGRAM_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_API_BASE": telegram_base,
+        "GEMINI_API_ENDPOINT": gemini_endpoint,
+        "GEMINI_API_INSECURE": "1",
+        "USER_STATE_BACKEND": "memory",
+        "STREAM_ANSWERS": "1" if args.stream else "0",
+        "TRACE_SLOW_KEEP": str(args.updates * 2),
+        "MODEL_PROBE_TIMEOUT": "5",
+        "CONTEXT_CACHE": "1" if args.context_cache else "0",
+        "QUOTA_ROUTING": "1" if args.quota_routing else "0",
+        "HEDGE_REQUESTS": "1" if args.hedge else "0",
+        "SINGLEFLIGHT": "1" if args.singleflight else "0",
+        "MODEL_CALL_TIMEOUT": str(args.model_call_timeout),
+    })
+    if args.gemini_rpm:
+        # Бот знает те же лимиты, что применяет заглушка
+        os.environ["MODEL_QUOTAS"] = json.dumps({
+            model: {"rpm": args.gemini_rpm}
+            for model in ("gemini-3-flash", "gemini-2.5-flash", "gemini-2.5-flash-lite", "gemini-1.5-flash")
+        })
+    for i in range(args.keys):
+        os.environ["GOOGLE_API_KEY" if i == 0 else f"GOOGLE_API_KEY_{i + 1}"] = f"fake-key-{i + 1}"
+
+    import medical_bot_main as bot_main
+    if not args.verbose:
+        bot_main.print = lambda *a, **k: None  # бот печатает на каждый апдейт
+        logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    rss_before = rss_mb()
+    if not await bot_main.model_manager.find_working_model():
+        raise RuntimeError("Заглушка Gemini не ответила на проверку модели")
+    await bot_main.get_bot_user()
+    gemini.calls.clear()
+
+    generator = TrafficGenerator(args, telegram)
+    feed_tasks = set()
+    started = time.perf_counter()
+    for _ in range(args.updates):
+        update = bot_main.types.Update.model_validate(generator.next_update(), context={"bot": bot_main.bot})
+        task = asyncio.create_task(bot_main.dp.feed_update(bot_main.bot, update))
+        feed_tasks.add(task)
+        task.add_done_callback(feed_tasks.discard)
+        await asyncio.sleep(random.expovariate(args.rate))
+    fed = time.perf_counter() - started
+
+    drained = await wait_drained(bot_main, feed_tasks, args.drain_timeout)
+    elapsed = time.perf_counter() - started
+
+    # Ответы модели — трассы, прошедшие через очередь; склеенные и фоновые сообщения не в счёт
+    traces = bot_main.slow_traces.slowest()
+    answered = [t.duration for t in traces if any(span[0] == "queue_wait" for span in t.spans)]
+    phases: Dict[str, List[float]] = {}
+    for trace in traces:
+        for name, _, duration, _ in trace.spans:
+            phases.setdefault(name, []).append(duration)
+
+    result = {
+        "updates": args.updates,
+        "drained": drained,
+        "feed_seconds": round(fed, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "updates_per_sec": round(args.updates / elapsed, 1),
+        "answers": len(answered),
+        "answers_per_sec": round(len(answered) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(answered, 50) * 1000, 1),
+            "p95": round(percentile(answered, 95) * 1000, 1),
+            "p99": round(percentile(answered, 99) * 1000, 1),
+            "max": round(max(answered, default=0.0) * 1000, 1),
+        },
+        "phase_p95_ms": {name: round(percentile(values, 95) * 1000, 1) for name, values in sorted(phases.items())},
+        "memory": {
+            "rss_before_mb": rss_before,
+            "rss_peak_mb": rss_mb(),
+            "user_states": bot_main.user_store.stats(),
+        },
+        "scheduler": bot_main.scheduler.stats(),
+        "answer_cache": bot_main.answer_cache.stats(),
+        "context_cache": bot_main.context_cache.stats(),
+        "hedging": bot_main.hedger.stats(),
+        "telegram_sender": bot_main.telegram_sender.stats(),
+        "singleflight": bot_main.singleflight.stats(),
+        "generations": bot_main.generations.stats(),
+        "telegram_calls": dict(telegram.calls),
+        "telegram_429": dict(telegram.rate_limited),
+        "gemini_calls": sum(gemini.calls.values()),
+        "gemini_429": sum(gemini.quota_errors.values()),
+        "gemini_cache_calls": dict(gemini.cache_calls),
+        "gemini_slow_calls": gemini.slow_calls,
+        "gemini_503": gemini.unavailable_errors,
+        "model_requests": {"/".join(k): int(v) for k, v in bot_main.MODEL_REQUESTS.values.items()},
+        "retries": {"/".join(k): int(v) for k, v in bot_main.RETRIES.values.items()},
+        "gemini_calls_by_model": {
+            model: sum(n for (m, _), n in gemini.calls.items() if m == model)
+            for model in sorted({m for m, _ in gemini.calls})
+        },
+        "model": bot_main.model_manager.current_model_name,
+    }
+
+    await bot_main.bot.session.close()
+    await telegram.stop()
+    await gemini.stop()
+    return result
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест медицинского бота на заглушках")
+    parser.add_argument("--updates", type=int, default=300, help="сколько апдейтов подать")
+    parser.add_argument("--rate", type=float, default=30.0, help="апдейтов в секунду (пуассоновский поток)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--group-share", type=float, default=0.4, help="доля сообщений из групп")
+    parser.add_argument("--addressed-share", type=float, default=0.3, help="доля групповых сообщений с упоминанием бота")
+    parser.add_argument("--photo-share", type=float, default=0.1)
+    parser.add_argument("--repeat-share", type=float, default=0.3, help="доля дословно повторяющихся вопросов")
+    parser.add_argument("--photo-variants", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=3, help="сколько фейковых API ключей")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="секунд на полный ответ")
+    parser.add_argument("--gemini-first-chunk", type=float, default=0.3, help="секунд до первого чанка")
+    parser.add_argument("--gemini-chunks", type=int, default=6)
+    parser.add_argument("--gemini-429", type=float, default=0.0, help="доля ответов RESOURCE_EXHAUSTED")
+    parser.add_argument("--gemini-503", type=float, default=0.0, help="доля ответов UNAVAILABLE")
+    parser.add_argument("--gemini-prefill", type=float, default=0.05, help="секунд на 1000 символов инлайн-промта")
+    parser.add_argument("--gemini-cache-min-chars", type=int, default=0, help="минимальный размер кэша промта")
+    parser.add_argument("--context-cache", action="store_true", help="включить CONTEXT_CACHE в боте")
+    parser.add_argument("--gemini-rpm", type=int, default=0, help="минутный лимит заглушки на пару модель×ключ")
+    parser.add_argument("--quota-routing", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--gemini-slow-share", type=float, default=0.0, help="доля зависающих вызовов")
+    parser.add_argument("--gemini-slow-factor", type=float, default=10.0, help="во сколько раз они медленнее")
+    parser.add_argument("--hedge", action="store_true", help="включить HEDGE_REQUESTS в боте")
+    parser.add_argument("--singleflight", action=argparse.BooleanOptionalAction, default=True,
+                        help="SINGLEFLIGHT в боте: общий вызов модели для одинаковых вопросов")
+    parser.add_argument("--model-call-timeout", type=float, default=60, help="MODEL_CALL_TIMEOUT бота, секунд")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="доля sendMessage/editMessageText с 429")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать результат в файл")
+    parser.add_argument("--verbose", action="store_true", help="не глушить вывод бота")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,54 @@
 import os
+import re
+import abc
+import time
 import asyncio
 import logging
+import resource
+import json
+import sqlite3
+import threading
+import hashlib
+import hmac
+import bisect
+import heapq
+import itertools
+import random
 import sys
 from io import BytesIO
 from typing import Optional, List, Dict, Tuple
-from datetime import datetime
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 import aiohttp
 from PIL import Image
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import BaseFilter, CommandStart, Command
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+    GenerativeServiceGrpcAsyncIOTransport,
+)
+from google.ai.generativelanguage_v1beta.services.cache_service.transports import (
+    CacheServiceGrpcAsyncIOTransport,
+)
+import grpc
 
 # ═══════════════════════════════════════════════════════════════
 # ⚙️ КОНФИГУРАЦИЯ
@@ -35,6 +65,18 @@ GOOGLE_KEYS = [
 ]
 RENDER_URL = os.getenv("RENDER_EXTERNAL_URL")
 
+# Свой Bot API сервер (telegram-bot-api) или локальная заглушка для нагрузочных тестов
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")
+# Свой endpoint Gemini (прокси или заглушка); INSECURE — gRPC без TLS, ключ идёт в метаданных
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+GEMINI_API_INSECURE = os.getenv("GEMINI_API_INSECURE", "0") == "1"
+
+# Получение апдейтов: polling | webhook (через FastAPI на RENDER_EXTERNAL_URL)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Общий для всех инстансов секрет; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256((TOKEN or "").encode()).hexdigest()[:32]
+
 GOOGLE_KEYS = [k for k in GOOGLE_KEYS if k]
 
 generation_config = {
@@ -46,6 +88,111 @@ generation_config = {
 
 MSK_TZ = ZoneInfo("Europe/Moscow")
 
+# Поиск рабочей модели: параллельная проверка всех пар модель×ключ
+MODEL_PROBE_PARALLEL = os.getenv("MODEL_PROBE_PARALLEL", "1") == "1"
+MODEL_PROBE_TIMEOUT = float(os.getenv("MODEL_PROBE_TIMEOUT", "15"))  # секунд на одну проверку
+MODEL_PROBE_FANOUT = int(os.getenv("MODEL_PROBE_FANOUT", "8"))        # одновременных проверок
+
+# Восстановление после лимитов (circuit breaker на каждую пару модель×ключ)
+QUOTA_COOLDOWN_MINUTE = float(os.getenv("QUOTA_COOLDOWN_MINUTE", "60"))     # минутная квота
+QUOTA_COOLDOWN_DEFAULT = float(os.getenv("QUOTA_COOLDOWN_DEFAULT", "300"))  # тип квоты неизвестен
+MODEL_RECOVERY_INTERVAL = float(os.getenv("MODEL_RECOVERY_INTERVAL", "60")) # проверка более точных моделей
+
+# Снимок состояния моделей для тёплого старта (пустой путь — выключено)
+MODEL_SNAPSHOT_PATH = os.getenv("MODEL_SNAPSHOT_PATH", "model_state.json")
+MODEL_SNAPSHOT_INTERVAL = float(os.getenv("MODEL_SNAPSHOT_INTERVAL", "60"))        # секунд между сохранениями
+MODEL_SNAPSHOT_MAX_AGE = float(os.getenv("MODEL_SNAPSHOT_MAX_AGE", str(6 * 3600)))  # старше — ищем модель заново
+QUOTA_RESET_TZ = ZoneInfo("America/Los_Angeles")  # дневные квоты Gemini сбрасываются в полночь PT
+
+# Локальный учёт квот: запрос заранее уходит на пару модель×ключ с запасом по лимитам
+QUOTA_ROUTING = os.getenv("QUOTA_ROUTING", "1") == "1"
+QUOTA_HEAVY_TOKENS = int(os.getenv("QUOTA_HEAVY_TOKENS", "1500"))     # длинный вопрос (оценка входных токенов)
+QUOTA_RESERVE_SHARE = float(os.getenv("QUOTA_RESERVE_SHARE", "0.3"))  # доля лимитов лучшей модели под тяжёлые вопросы
+QUOTA_IMAGE_TOKENS = 258                                              # столько токенов Gemini считает за картинку
+
+# Опубликованные лимиты бесплатного уровня на ключ; MODEL_QUOTAS='{"gemini-2.5-flash": {"rpm": 10}}' дополняет
+DEFAULT_MODEL_QUOTAS = {
+    "gemini-3-flash": {"rpm": 10, "rpd": 250, "tpm": 250000},
+    "gemini-2.5-flash": {"rpm": 10, "rpd": 250, "tpm": 250000},
+    "gemini-2.5-flash-lite": {"rpm": 15, "rpd": 1000, "tpm": 250000},
+    "gemini-1.5-flash": {"rpm": 15, "rpd": 1500, "tpm": 1000000},
+}
+MODEL_QUOTAS = {model: dict(limits) for model, limits in DEFAULT_MODEL_QUOTAS.items()}
+for _model, _limits in json.loads(os.getenv("MODEL_QUOTAS") or "{}").items():
+    MODEL_QUOTAS.setdefault(_model, {}).update(_limits)
+
+# Дублирующие запросы: если модель молчит дольше p95, тот же запрос уходит на другой ключ/модель
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_MAX_SHARE = float(os.getenv("HEDGE_MAX_SHARE", "0.1"))        # не больше 10% запросов с дублем
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))        # секунд, нижняя граница порога
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "8"))  # порог, пока мало замеров
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))                # последних замеров на модель
+HEDGE_MIN_SAMPLES = 20
+
+# Повторы вызова модели на один вопрос
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))   # секунд, растёт вдвое с каждой попыткой
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))
+RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "90"))        # секунд на вопрос со всеми повторами
+MODEL_CALL_TIMEOUT = float(os.getenv("MODEL_CALL_TIMEOUT", "60"))  # секунд на одну попытку (0 — без лимита)
+
+# Потоковые ответы: первое сообщение сразу, дальше — редактирование по мере генерации
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))              # личка: сек между правками
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", "3.5"))  # группы: лимит 20 в минуту
+
+# Серверный кэш системных промтов (Gemini context caching), по умолчанию выключен
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))                 # секунд жизни кэша
+CONTEXT_CACHE_REFRESH_MARGIN = float(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN", "300"))  # продлеваем заранее
+CONTEXT_CACHE_RETRY = float(os.getenv("CONTEXT_CACHE_RETRY", "120"))             # пауза после временной ошибки
+
+# Исходящие сообщения: лимиты Telegram на бота и на чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))          # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))               # в секунду в личке
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", "20"))            # в минуту в группе
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv("TELEGRAM_SEND_ATTEMPTS", "5"))         # попыток при flood control
+
+# Кэш ответов на повторяющиеся первые вопросы
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))  # секунд
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "1") == "1"  # одинаковые одновременные первые вопросы — один вызов модели
+
+# Хранилище состояний пользователей
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "5000"))
+USER_STATE_IDLE_TTL = float(os.getenv("USER_STATE_IDLE_TTL", str(24 * 3600)))   # секунд без активности
+USER_STATE_SWEEP_INTERVAL = float(os.getenv("USER_STATE_SWEEP_INTERVAL", "600"))
+
+# Сохранение состояний между перезапусками: sqlite | memory
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "sqlite")
+USER_STATE_DB_PATH = os.getenv("USER_STATE_DB_PATH", "user_states.db")
+USER_STATE_FLUSH_INTERVAL = float(os.getenv("USER_STATE_FLUSH_INTERVAL", "2"))  # секунд между пакетами записи
+
+# История диалога: бюджет в токенах, всё старше сворачивается в краткое содержание
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_COMPACT_TARGET = float(os.getenv("HISTORY_COMPACT_TARGET", "0.5"))  # доля бюджета, до которой сжимаем
+HISTORY_CHARS_PER_TOKEN = float(os.getenv("HISTORY_CHARS_PER_TOKEN", "3"))  # грубая оценка для кириллицы
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "1500"))
+
+# Фото: берём наименьший размер не меньше целевого, сжимаем вне event loop
+IMAGE_TARGET_SIDE = int(os.getenv("IMAGE_TARGET_SIDE", "1024"))    # пикселей по длинной стороне
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Склейка серии сообщений одного пользователя (0 — выключено)
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "1500"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+
+# Очередь запросов к модели: лимит одновременных запросов на каждый здоровый ключ
+SCHEDULER_SLOTS_PER_KEY = int(os.getenv("SCHEDULER_SLOTS_PER_KEY", "2"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+SCHEDULER_NOTIFY_POSITION = int(os.getenv("SCHEDULER_NOTIFY_POSITION", "2"))  # с какой позиции сообщать об очереди
+
+# Трассировка: храним N самых медленных запросов, опционально пишем в файл (Chrome Trace Event)
+TRACE_SLOW_KEEP = int(os.getenv("TRACE_SLOW_KEEP", "50"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")  # /debug/traces выключен, пока не задан; запрос — с X-Debug-Token
+
 # ПРИОРИТЕТ МОДЕЛЕЙ (от САМОЙ ТОЧНОЙ для медицины к худшей)
 # Критерий: ТОЧНОСТЬ > СКОРОСТЬ, потому что медицина критична
 MODEL_PRIORITY = [
@@ -228,10 +375,726 @@ SYSTEM_PROMPT_OBSTETRICS = """Ты — профессиональный акуш
 - Сроки в неделях + дни (38+6 недель, не "38 с половиной")
 - МАКСИМУМ 3000 символов!"""
 
+MODE_PROMPTS = {
+    "medicine_general": SYSTEM_PROMPT_GENERAL_MEDICINE,
+    "medicine_gynecology": SYSTEM_PROMPT_GYNECOLOGY,
+    "medicine_obstetrics": SYSTEM_PROMPT_OBSTETRICS,
+}
+
+SYSTEM_PROMPT_HISTORY_SUMMARY = f"""Ты сжимаешь медицинский диалог пользователя с ассистентом.
+Сохрани: вопросы пользователя, ключевые факты о пациенте (возраст, срок беременности, диагнозы, препараты),
+главные выводы и названные источники (PMID, гайдлайны).
+Пиши кратко, пунктами, на русском. Не добавляй ничего от себя.
+МАКСИМУМ {HISTORY_SUMMARY_MAX_CHARS} символов!"""
+
+# Служебные промты (не режимы пользователя), тоже кэшируются в ModelRegistry
+SERVICE_PROMPTS = {
+    "history_summary": SYSTEM_PROMPT_HISTORY_SUMMARY,
+}
+
+MODE_NAMES = {
+    "medicine_general": "🏥 Общая медицина",
+    "medicine_gynecology": "👶 Гинекология",
+    "medicine_obstetrics": "🤰 Акушерство",
+}
+
+# ═══════════════════════════════════════════════════════════════
+# 📈 МЕТРИКИ (формат Prometheus)
+# ═══════════════════════════════════════════════════════════════
+
+METRICS = []
+
+def _labels_text(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Счётчик с метками. inc() — одна операция со словарём."""
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        METRICS.append(self)
+    
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_labels_text(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами (секунды)."""
+    
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # {метки: [счётчики по бакетам (+Inf последним), сумма]}
+        self.values: Dict[Tuple, List] = {}
+        METRICS.append(self)
+    
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                labels = _labels_text(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Gauge:
+    """Значение, которое считается в момент сбора метрик."""
+    
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        METRICS.append(self)
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+MODEL_CALL_SECONDS = Histogram("medbot_model_call_seconds", "Model call latency", ("model", "api", "mode"))
+IMAGE_DOWNLOAD_SECONDS = Histogram("medbot_image_download_seconds", "Telegram photo download latency")
+TELEGRAM_SEND_SECONDS = Histogram("medbot_telegram_send_seconds", "Telegram send/edit latency", ("method",))
+REQUESTS_BY_MODE = Counter("medbot_requests_total", "Questions by mode", ("mode",))
+MODEL_REQUESTS = Counter("medbot_model_requests_total", "Model calls by model, key and outcome", ("model", "api", "status"))
+QUOTA_ERRORS = Counter("medbot_quota_errors_total", "429 / quota errors by model and key", ("model", "api"))
+MODEL_SWITCHES = Counter("medbot_model_switches_total", "Failovers / upgrades of the current model", ("to_model",))
+TOKENS = Counter("medbot_tokens_total", "Tokens from usage metadata", ("model", "direction"))
+HEDGES = Counter("medbot_hedges_total", "Hedged model calls by winner", ("winner",))
+RETRIES = Counter("medbot_model_retries_total", "Model call retries by error kind", ("kind",))
+SINGLEFLIGHT_REQUESTS = Counter(
+    "medbot_singleflight_total", "First-turn questions by singleflight role", ("role",)
+)
+MODEL_TIMEOUTS = Counter("medbot_model_timeouts_total", "Model calls past MODEL_CALL_TIMEOUT", ("model",))
+GENERATIONS_CANCELLED = Counter(
+    "medbot_generations_cancelled_total", "Superseded answer generations by reason", ("reason",)
+)
+
+# Читаются в момент сбора метрик (объекты создаются ниже по файлу)
+Gauge("medbot_queue_depth", "Requests waiting in the scheduler", lambda: scheduler.queued)
+Gauge("medbot_requests_in_flight", "Model requests running", lambda: scheduler.running)
+Gauge("medbot_active_users", "User states held in memory", lambda: len(user_store))
+Gauge("medbot_answer_cache_hits", "Answer cache hits", lambda: answer_cache.hits)
+Gauge("medbot_answer_cache_misses", "Answer cache misses", lambda: answer_cache.misses)
+Gauge("medbot_context_cache_hits", "Requests served with a cached system prompt", lambda: context_cache.hits)
+Gauge("medbot_context_cache_inline", "Requests sent with an inline system prompt while caching is on", lambda: context_cache.inline)
+
+def record_usage(model_name: str, response):
+    """Счётчики токенов из usage_metadata ответа."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    TOKENS.inc(model_name, "input", amount=usage.prompt_token_count or 0)
+    TOKENS.inc(model_name, "output", amount=usage.candidates_token_count or 0)
+    TOKENS.inc(model_name, "cached", amount=usage.cached_content_token_count or 0)
+
+# ═══════════════════════════════════════════════════════════════
+# 🔬 ТРАССИРОВКА ЗАПРОСОВ
+# ═══════════════════════════════════════════════════════════════
+
+_TRACE_IDS = itertools.count(1)
+_CURRENT_TRACE: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+class Trace:
+    """Фазы обработки одного апдейта: [(имя, начало от старта, длительность, атрибуты)]."""
+    
+    def __init__(self, name: str, attrs: Dict):
+        self.trace_id = next(_TRACE_IDS)
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[Tuple[str, float, float, Dict]] = []
+    
+    def add_span(self, name: str, started: float, ended: Optional[float] = None, **attrs):
+        ended = time.perf_counter() if ended is None else ended
+        self.spans.append((name, started - self.t0, ended - started, attrs))
+    
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": datetime.fromtimestamp(self.started_at, MSK_TZ).isoformat(),
+            "duration_ms": round(self.duration * 1000, 1),
+            "attrs": self.attrs,
+            "spans": [
+                {"name": name, "offset_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1), **attrs}
+                for name, offset, duration, attrs in self.spans
+            ],
+        }
+    
+    def to_chrome_events(self) -> List[Dict]:
+        """События в формате Chrome Trace Event (chrome://tracing, Perfetto)."""
+        start_us = self.started_at * 1e6
+        events = [{
+            "name": self.name, "ph": "X", "pid": 1, "tid": self.trace_id,
+            "ts": start_us, "dur": self.duration * 1e6, "args": self.attrs,
+        }]
+        for name, offset, duration, attrs in self.spans:
+            events.append({
+                "name": name, "ph": "X", "pid": 1, "tid": self.trace_id,
+                "ts": start_us + offset * 1e6, "dur": duration * 1e6, "args": attrs,
+            })
+        return events
+
+class SlowTraceBuffer:
+    """Хранит N самых медленных трасс (min-heap по длительности)."""
+    
+    def __init__(self, keep: int, export_path: Optional[str]):
+        self.keep = keep
+        self.export_path = export_path
+        self.heap: List[Tuple[float, int, Trace]] = []
+        self.finished = 0
+    
+    def offer(self, trace: Trace):
+        self.finished += 1
+        item = (trace.duration, trace.trace_id, trace)
+        if len(self.heap) < self.keep:
+            heapq.heappush(self.heap, item)
+        elif self.heap and trace.duration > self.heap[0][0]:
+            heapq.heapreplace(self.heap, item)
+        else:
+            return
+        if self.export_path:
+            self._export(trace)
+    
+    def _export(self, trace: Trace):
+        # JSON Array Format: закрывающая ] не обязательна, файл можно дописывать
+        try:
+            new_file = not os.path.exists(self.export_path)
+            with open(self.export_path, "a", encoding="utf-8") as f:
+                if new_file:
+                    f.write("[\n")
+                for event in trace.to_chrome_events():
+                    f.write(json.dumps(event, ensure_ascii=False) + ",\n")
+        except OSError as e:
+            print(f"⚠️ Не удалось записать трассу: {e}")
+    
+    def slowest(self) -> List[Trace]:
+        return [trace for _, _, trace in sorted(self.heap, reverse=True)]
+
+slow_traces = SlowTraceBuffer(TRACE_SLOW_KEEP, TRACE_EXPORT_PATH)
+
+def start_trace(name: str, **attrs) -> Trace:
+    """Начинает трассу и делает её текущей для этой задачи."""
+    trace = Trace(name, attrs)
+    _CURRENT_TRACE.set(trace)
+    return trace
+
+def current_trace() -> Optional[Trace]:
+    return _CURRENT_TRACE.get()
+
+def use_trace(trace: Optional[Trace]):
+    """Продолжает трассу в другой задаче (склейка, очередь)."""
+    _CURRENT_TRACE.set(trace)
+
+def finish_trace(trace: Optional[Trace]):
+    if trace is None:
+        return
+    trace.duration = time.perf_counter() - trace.t0
+    slow_traces.offer(trace)
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """Замеряет фазу текущей трассы (без трассы — ничего не делает)."""
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        yield attrs
+        return
+    started = time.perf_counter()
+    try:
+        yield attrs  # атрибуты можно дополнить внутри блока
+    finally:
+        trace.add_span(name, started, **attrs)
+
+def record_span(name: str, started: float, ended: Optional[float] = None, **attrs):
+    """Добавляет в текущую трассу фазу с явными границами (perf_counter)."""
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add_span(name, started, ended, **attrs)
+
 # ═══════════════════════════════════════════════════════════════
 # 🤖 СИСТЕМА УПРАВЛЕНИЯ МОДЕЛЯМИ (С ПРИОРИТЕТОМ НА ТОЧНОСТЬ)
 # ═══════════════════════════════════════════════════════════════
 
+def is_quota_error(error_str: str) -> bool:
+    """Ошибка лимита (429 / квота)."""
+    return "429" in error_str or "quota" in error_str or "RESOURCE_EXHAUSTED" in error_str
+
+def quota_cooldown(error_str: str) -> float:
+    """
+    Сколько секунд пара модель×ключ должна отдыхать после ошибки лимита.
+    Дневная квота — до полуночи PT, минутная — минута (или подсказка retry_delay).
+    """
+    hint = None
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_str) or \
+        re.search(r"retry in ([\d.]+)\s*s", error_str, re.IGNORECASE)
+    if match:
+        hint = float(match.group(1))
+    
+    if "PerDay" in error_str or "per day" in error_str.lower():
+        now = datetime.now(QUOTA_RESET_TZ)
+        reset = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return max((reset - now).total_seconds(), hint or 0)
+    if "PerMinute" in error_str or "per minute" in error_str.lower():
+        return max(QUOTA_COOLDOWN_MINUTE, hint or 0)
+    return hint if hint is not None else QUOTA_COOLDOWN_DEFAULT
+
+class PairBreaker:
+    """
+    Circuit breaker одной пары модель×ключ.
+    closed — работает; open — в лимите до open_until;
+    half_open — лимит истёк, разрешён ровно один пробный запрос.
+    """
+    
+    def __init__(self):
+        self.state = "closed"
+        self.open_until = 0.0
+        self.failures = 0
+        self.trial_in_flight = False
+    
+    def available(self) -> bool:
+        if self.state == "open" and time.time() >= self.open_until:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.trial_in_flight
+        return self.state == "closed"
+    
+    def begin(self):
+        """Запрос стартовал. В half_open он становится пробным."""
+        if self.state == "half_open":
+            self.trial_in_flight = True
+    
+    def release(self):
+        """Запрос завершился без вердикта (не лимит и не успех)."""
+        self.trial_in_flight = False
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+    
+    def record_failure(self, cooldown: float, per_day: bool = False):
+        # Пробный запрос снова упёрся в лимит — удваиваем паузу
+        if self.state == "half_open":
+            self.failures += 1
+        # Дневная пауза и так длится до сброса в полночь PT — удвоение пропустило бы сброс
+        if not per_day:
+            cooldown *= 2 ** min(self.failures, 4)
+        self.state = "open"
+        self.open_until = max(self.open_until, time.time() + cooldown)
+        self.trial_in_flight = False
+
+class TokenBucket:
+    """Ведро на capacity токенов, пополняется на rate в секунду. Может уйти в минус (долг)."""
+    
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def level(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+    
+    def take(self, amount: float):
+        self.tokens = self.level() - amount
+    
+    def drain(self):
+        self.tokens = min(self.level(), 0.0)
+
+class PairQuota:
+    """
+    Локальная копия лимитов одной пары модель×ключ:
+    RPM и TPM — ведра с пополнением за минуту, RPD — счётчик до полуночи PT.
+    """
+    
+    def __init__(self, limits: Dict):
+        rpm, tpm = limits.get("rpm"), limits.get("tpm")
+        self.rpm = TokenBucket(rpm, rpm / 60) if rpm else None
+        self.tpm = TokenBucket(tpm, tpm / 60) if tpm else None
+        self.rpd = limits.get("rpd")
+        self.day = None
+        self.day_used = 0
+    
+    def _day_left(self) -> Optional[float]:
+        if not self.rpd:
+            return None
+        today = datetime.now(QUOTA_RESET_TZ).date()
+        if today != self.day:
+            self.day = today
+            self.day_used = 0
+        return self.rpd - self.day_used
+    
+    def headroom(self, tokens: int) -> float:
+        """Доля лимита, которая останется после запроса (меньше 0 — запрос не влезет)."""
+        shares = [1.0]
+        if self.rpm:
+            shares.append((self.rpm.level() - 1) / self.rpm.capacity)
+        if self.tpm:
+            shares.append((self.tpm.level() - tokens) / self.tpm.capacity)
+        day_left = self._day_left()
+        if day_left is not None:
+            shares.append((day_left - 1) / self.rpd)
+        return min(shares)
+    
+    def reserve(self, tokens: int):
+        if self.rpm:
+            self.rpm.take(1)
+        if self.tpm:
+            self.tpm.take(tokens)
+        if self._day_left() is not None:
+            self.day_used += 1
+    
+    def settle(self, reserved: int, actual: int):
+        """Поправка TPM на фактические токены из usage_metadata."""
+        if self.tpm:
+            self.tpm.take(actual - reserved)
+    
+    def exhaust(self, per_day: bool):
+        """API ответил 429 — локальные лимиты тоже считаем исчерпанными."""
+        if per_day and self._day_left() is not None:
+            self.day_used = self.rpd
+        elif self.rpm:
+            self.rpm.drain()
+    
+    def stats(self) -> Dict:
+        stats = {}
+        if self.rpm:
+            stats["rpm_left"] = int(self.rpm.level())
+        if self.tpm:
+            stats["tpm_left"] = int(self.tpm.level())
+        day_left = self._day_left()
+        if day_left is not None:
+            stats["rpd_left"] = day_left
+        return stats
+
+class _ApiKeyMetadata:
+    """Добавляет x-goog-api-key к вызовам по незащищённому каналу (там нет credentials)."""
+    
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+    
+    def _details(self, details):
+        metadata = grpc.aio.Metadata(*(details.metadata or ()), ("x-goog-api-key", self.api_key))
+        return details._replace(metadata=metadata)
+    
+    @classmethod
+    def interceptors(cls, api_key: str) -> List:
+        # grpc.aio относит перехватчик только к одному типу вызовов — нужен отдельный на каждый
+        return [_ApiKeyUnaryUnary(api_key), _ApiKeyUnaryStream(api_key)]
+
+class _ApiKeyUnaryUnary(_ApiKeyMetadata, grpc.aio.UnaryUnaryClientInterceptor):
+    async def intercept_unary_unary(self, continuation, client_call_details, request):
+        return await continuation(self._details(client_call_details), request)
+
+class _ApiKeyUnaryStream(_ApiKeyMetadata, grpc.aio.UnaryStreamClientInterceptor):
+    async def intercept_unary_stream(self, continuation, client_call_details, request):
+        return await continuation(self._details(client_call_details), request)
+
+class KeyPool:
+    """
+    Пул API ключей: у каждого ключа свой независимый async-клиент Gemini.
+    Запросы распределяются по всем здоровым ключам (наименьшее число
+    запросов в работе, при равенстве — по кругу).
+    """
+    
+    def __init__(self, keys: List[str]):
+        self.keys = keys
+        self.clients: Dict[int, glm.GenerativeServiceAsyncClient] = {}
+        self.cache_clients: Dict[int, glm.CacheServiceAsyncClient] = {}
+        self.channels: Dict[int, grpc.aio.Channel] = {}
+        self.outstanding = [0] * len(keys)
+        self.total_requests = [0] * len(keys)
+        self._rr_cursor = 0
+    
+    def _make_client(self, api_index: int, client_class, transport_class):
+        api_key = self.keys[api_index]
+        if GEMINI_API_ENDPOINT and GEMINI_API_INSECURE:
+            # Один канал на ключ для всех сервисов
+            channel = self.channels.get(api_index)
+            if channel is None:
+                channel = grpc.aio.insecure_channel(GEMINI_API_ENDPOINT, interceptors=_ApiKeyMetadata.interceptors(api_key))
+                self.channels[api_index] = channel
+            return client_class(transport=transport_class(channel=channel))
+        client_options = {"api_key": api_key}
+        if GEMINI_API_ENDPOINT:
+            client_options["api_endpoint"] = GEMINI_API_ENDPOINT
+        return client_class(client_options=client_options)
+    
+    def client(self, api_index: int) -> glm.GenerativeServiceAsyncClient:
+        """Возвращает клиент ключа (создаётся один раз, без глобального genai.configure)."""
+        client = self.clients.get(api_index)
+        if client is None:
+            client = self._make_client(api_index, glm.GenerativeServiceAsyncClient, GenerativeServiceGrpcAsyncIOTransport)
+            self.clients[api_index] = client
+        return client
+    
+    def cache_client(self, api_index: int) -> glm.CacheServiceAsyncClient:
+        """Клиент CacheService того же ключа (кэш живёт в проекте ключа)."""
+        client = self.cache_clients.get(api_index)
+        if client is None:
+            client = self._make_client(api_index, glm.CacheServiceAsyncClient, CacheServiceGrpcAsyncIOTransport)
+            self.cache_clients[api_index] = client
+        return client
+    
+    def pick(self, candidates: List[int]) -> Optional[int]:
+        """Выбирает ключ с наименьшим числом запросов в работе."""
+        if not candidates:
+            return None
+        n = len(self.keys)
+        # Порядок обхода начинается с курсора — это даёт round-robin при равной загрузке
+        ordered = sorted(candidates, key=lambda i: (self.outstanding[i], (i - self._rr_cursor) % n))
+        chosen = ordered[0]
+        self._rr_cursor = (chosen + 1) % n
+        return chosen
+    
+    @asynccontextmanager
+    async def lease(self, candidates: List[int]):
+        """Занимает ключ на время запроса. Отдаёт None, если здоровых ключей нет."""
+        api_index = self.pick(candidates)
+        if api_index is None:
+            yield None
+            return
+        self.outstanding[api_index] += 1
+        self.total_requests[api_index] += 1
+        try:
+            yield api_index
+        finally:
+            self.outstanding[api_index] -= 1
+    
+    def stats(self) -> List[Dict]:
+        return [
+            {"api": f"#{i + 1}", "in_flight": self.outstanding[i], "requests": self.total_requests[i]}
+            for i in range(len(self.keys))
+        ]
+
+key_pool = KeyPool(GOOGLE_KEYS)
+
+def build_model(model_name: str, api_index: int, system_instruction: str,
+                cached_content: Optional[str] = None) -> genai.GenerativeModel:
+    """
+    Создаёт GenerativeModel, привязанную к конкретному API ключу.
+    С cached_content системный промт уже лежит в кэше на сервере и не передаётся.
+    """
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=generation_config,
+        system_instruction=None if cached_content else system_instruction
+    )
+    if cached_content:
+        model._cached_content = cached_content
+    model._async_client = key_pool.client(api_index)
+    return model
+
+class ModelRegistry:
+    """
+    Кэш готовых GenerativeModel по (модель, режим, ключ).
+    Каждый хэндл создаётся один раз и переиспользуется на горячем пути.
+    """
+    
+    def __init__(self):
+        self.handles: Dict[Tuple[str, str, int], genai.GenerativeModel] = {}
+    
+    def get(self, model_name: str, mode: str, api_index: int,
+            cached_content: Optional[str] = None) -> genai.GenerativeModel:
+        key = (model_name, mode, api_index)
+        handle = self.handles.get(key)
+        # Кэш промта создан заново или пропал — хэндл пересобирается
+        if handle is None or handle.cached_content != cached_content:
+            handle = build_model(
+                model_name, api_index, MODE_PROMPTS.get(mode) or SERVICE_PROMPTS[mode], cached_content
+            )
+            self.handles[key] = handle
+        return handle
+    
+    def drop(self, model_name: str, api_index: Optional[int] = None):
+        """Удаляет хэндлы модели (на одном ключе или на всех)."""
+        for key in list(self.handles):
+            if key[0] == model_name and (api_index is None or key[2] == api_index):
+                del self.handles[key]
+    
+    def drop_except(self, model_name: str):
+        """После переключения модели оставляет только хэндлы текущей."""
+        for key in list(self.handles):
+            if key[0] != model_name:
+                del self.handles[key]
+
+model_registry = ModelRegistry()
+
+class ContextCache:
+    """
+    Системные промты режимов в серверном кэше Gemini (CachedContent).
+    ├─ один кэш на модель×режим×ключ: кэш принадлежит проекту ключа
+    ├─ создаётся при первом запросе, продлевается (ttl) незадолго до истечения
+    ├─ модель без поддержки кэша или слишком короткий промт → навсегда инлайн
+    └─ временная ошибка (429, 5xx) → инлайн на CONTEXT_CACHE_RETRY секунд
+    """
+    
+    def __init__(self, enabled: bool, ttl: float, refresh_margin: float, retry_interval: float):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        # {(model, mode, api_index): (имя CachedContent, время истечения)}
+        self.entries: Dict[Tuple[str, str, int], Tuple[str, float]] = {}
+        # До какого времени идти с инлайн-промтом: по модели×режиму и по отдельной тройке
+        self.unsupported: Dict[Tuple[str, str], str] = {}
+        self.retry_at: Dict[Tuple[str, str, int], float] = {}
+        self.locks: Dict[Tuple[str, str, int], asyncio.Lock] = {}
+        self._tasks = set()
+        self.hits = 0
+        self.created = 0
+        self.refreshed = 0
+        self.inline = 0
+    
+    async def lookup(self, model_name: str, mode: str, api_index: int) -> Optional[str]:
+        """Имя CachedContent для запроса или None — тогда промт идёт инлайн."""
+        if not self.enabled or mode not in MODE_PROMPTS:
+            return None
+        key = (model_name, mode, api_index)
+        if (model_name, mode) in self.unsupported or self.retry_at.get(key, 0) > time.time():
+            self.inline += 1
+            return None
+        
+        entry = self.entries.get(key)
+        if entry and entry[1] - self.refresh_margin > time.time():
+            self.hits += 1
+            return entry[0]
+        
+        # Создание и продление — один запрос на тройку, остальные ждут его
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] - self.refresh_margin > time.time():
+                self.hits += 1
+                return entry[0]
+            try:
+                return await self._ensure(key, entry)
+            except Exception as e:
+                self._fail(key, str(e))
+                self.inline += 1
+                return None
+    
+    async def _ensure(self, key: Tuple[str, str, int], entry: Optional[Tuple[str, float]]) -> str:
+        model_name, mode, api_index = key
+        client = key_pool.cache_client(api_index)
+        ttl = timedelta(seconds=self.ttl)
+        
+        if entry and entry[1] > time.time():
+            try:
+                cached = await client.update_cached_content(
+                    cached_content=glm.CachedContent(name=entry[0], ttl=ttl),
+                    update_mask={"paths": ["ttl"]},
+                )
+                self.refreshed += 1
+                return self._store(key, cached)
+            except Exception as e:
+                # Кэш уже удалён на сервере — создаём заново
+                if not self.is_missing_error(str(e)):
+                    raise
+        
+        cached = await client.create_cached_content(cached_content=glm.CachedContent(
+            model=f"models/{model_name}",
+            display_name=f"medbot-{mode}",
+            system_instruction=glm.Content(parts=[glm.Part(text=MODE_PROMPTS[mode])]),
+            ttl=ttl,
+        ))
+        self.created += 1
+        print(f"🗄️ Кэш промта создан: {model_name} [{MODE_NAMES[mode]}] API #{api_index + 1}")
+        return self._store(key, cached)
+    
+    def _store(self, key: Tuple[str, str, int], cached: glm.CachedContent) -> str:
+        expires = cached.expire_time.timestamp() if cached.expire_time else time.time() + self.ttl
+        self.entries[key] = (cached.name, expires)
+        self.retry_at.pop(key, None)
+        return cached.name
+    
+    def _fail(self, key: Tuple[str, str, int], error_str: str):
+        model_name, mode, api_index = key
+        lowered = error_str.lower()
+        if is_quota_error(error_str) or not any(s in lowered for s in ("400", "404", "invalid", "not supported", "too small")):
+            self.retry_at[key] = time.time() + self.retry_interval
+            print(f"⚠️ Кэш промта недоступен ({model_name}, API #{api_index + 1}): {error_str[:80]}")
+        else:
+            # Модель не поддерживает кэш или промт короче минимального размера кэша
+            self.unsupported[(model_name, mode)] = error_str[:200]
+            print(f"ℹ️ {model_name} [{MODE_NAMES[mode]}] без кэша промта: {error_str[:80]}")
+    
+    @staticmethod
+    def is_missing_error(error_str: str) -> bool:
+        lowered = error_str.lower()
+        return ("404" in lowered or "not found" in lowered or "not_found" in lowered)
+    
+    def invalidate(self, model_name: str, mode: str, api_index: int):
+        """Кэш отклонён при генерации (истёк, удалён) — забываем и временно идём инлайн."""
+        key = (model_name, mode, api_index)
+        self.entries.pop(key, None)
+        self.retry_at[key] = time.time() + self.retry_interval
+    
+    def release_except(self, model_name: str):
+        """После переключения модели удаляет кэши остальных моделей (хранение платное)."""
+        for key in [key for key in self.entries if key[0] != model_name]:
+            name, _ = self.entries.pop(key)
+            task = asyncio.create_task(self._delete(key[2], name))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _delete(self, api_index: int, name: str):
+        try:
+            await key_pool.cache_client(api_index).delete_cached_content(name=name)
+        except Exception as e:
+            print(f"⚠️ Не удалось удалить кэш {name}: {str(e)[:80]}")
+    
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "caches": len(self.entries),
+            "hits": self.hits,
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "inline": self.inline,
+            "unsupported": [f"{model}/{mode}" for model, mode in self.unsupported],
+        }
+
+context_cache = ContextCache(CONTEXT_CACHE, CONTEXT_CACHE_TTL, CONTEXT_CACHE_REFRESH_MARGIN, CONTEXT_CACHE_RETRY)
+
 class ModelManager:
     """Управляет доступными моделями с приоритетом на ТОЧНОСТЬ."""
     
@@ -239,15 +1102,158 @@ class ModelManager:
         self.api_key_index = 0
         self.current_model = None
         self.current_model_name = "Searching..."
-        # Отслеживаем лимиты: {model_name: {api_index: is_limited}}
-        self.model_limits = {}
+        # Circuit breaker на каждую пару: {(model_name, api_index): PairBreaker}
+        self.breakers: Dict[Tuple[str, int], PairBreaker] = {}
+        # Локальный учёт лимитов пары: {(model_name, api_index): PairQuota}
+        self.quotas: Dict[Tuple[str, int], PairQuota] = {}
+        self.verify_task: Optional[asyncio.Task] = None  # фоновая проверка модели после тёплого старта
+        self.search_task: Optional[asyncio.Task] = None  # идущий find_working_model, общий для всех
+    
+    def breaker(self, model_name: str, api_index: int) -> PairBreaker:
+        key = (model_name, api_index)
+        if key not in self.breakers:
+            self.breakers[key] = PairBreaker()
+        return self.breakers[key]
+    
+    def quota(self, model_name: str, api_index: int) -> PairQuota:
+        key = (model_name, api_index)
+        if key not in self.quotas:
+            self.quotas[key] = PairQuota(MODEL_QUOTAS.get(model_name, {}))
+        return self.quotas[key]
+    
+    def _is_limited(self, model_name: str, api_index: int) -> bool:
+        return not self.breaker(model_name, api_index).available()
+    
+    def healthy_keys(self, model_name: str) -> List[int]:
+        """Ключи, на которых модель не в лимите."""
+        return [i for i in range(len(GOOGLE_KEYS)) if not self._is_limited(model_name, i)]
+    
+    def keys_with_capacity(self, model_name: str, tokens: int, heavy: bool) -> List[int]:
+        """Здоровые ключи, у которых по локальным лимитам хватит запаса на запрос."""
+        # Лучшая доступная модель держит запас под длинные вопросы и вопросы с фото
+        reserve = 0.0 if heavy or model_name != self.current_model_name else QUOTA_RESERVE_SHARE
+        if model_name == MODEL_PRIORITY[-1]:
+            reserve = 0.0  # ниже уходить некуда
+        return [
+            i for i in self.healthy_keys(model_name)
+            if self.quota(model_name, i).headroom(tokens) >= reserve
+        ]
     
-    async def find_working_model(self):
+    def route(self, tokens: int = 0, heavy: bool = False) -> str:
+        """
+        Модель для запроса: самая точная (от текущей вниз), у которой есть запас
+        по локальным лимитам. Лёгкие вопросы не трогают резерв лучшей модели,
+        пока есть куда уйти. Если запаса нет нигде — текущая модель (решит API).
+        """
+        current = self.current_model_name
+        if not QUOTA_ROUTING or current not in MODEL_PRIORITY:
+            return current
+        candidates = MODEL_PRIORITY[MODEL_PRIORITY.index(current):]
+        for allow_reserve in ((heavy,) if heavy else (False, True)):
+            for model_name in candidates:
+                if self.keys_with_capacity(model_name, tokens, allow_reserve):
+                    return model_name
+        return current
+    
+    def hedge_target(self, model_name: str, api_index: Optional[int], tokens: int) -> Optional[str]:
+        """
+        Модель для дублирующего запроса: та же (на другом ключе) или следующая
+        по приоритету. Только пары с запасом по лимитам — дубль не должен съедать квоту.
+        """
+        if [i for i in self.keys_with_capacity(model_name, tokens, True) if i != api_index]:
+            return model_name
+        if model_name in MODEL_PRIORITY:
+            for lower in MODEL_PRIORITY[MODEL_PRIORITY.index(model_name) + 1:]:
+                if self.keys_with_capacity(lower, tokens, True):
+                    return lower
+        return None
+    
+    @asynccontextmanager
+    async def lease_key(self, model_name: Optional[str] = None, tokens: int = 0, heavy: bool = False,
+                        exclude: Optional[int] = None):
+        """
+        Занимает наименее загруженный здоровый ключ модели (по умолчанию текущей),
+        предпочитая ключи с запасом по локальным лимитам, и списывает с них запрос.
+        exclude — ключ, который брать нельзя (занят основным запросом при дубле).
+        Успешный выход закрывает breaker пары; лимит отмечает handle_limit_error.
+        """
+        model_name = model_name or self.current_model_name
+        candidates = [i for i in self.healthy_keys(model_name) if i != exclude]
+        if QUOTA_ROUTING:
+            candidates = (
+                [i for i in self.keys_with_capacity(model_name, tokens, heavy) if i != exclude]
+                or [i for i in self.keys_with_capacity(model_name, tokens, True) if i != exclude]
+                or candidates
+            )
+        async with key_pool.lease(candidates) as api_index:
+            if api_index is None:
+                yield None
+                return
+            self.quota(model_name, api_index).reserve(tokens)
+            breaker = self.breaker(model_name, api_index)
+            breaker.begin()
+            try:
+                yield api_index
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+    
+    def record_limit(self, model_name: str, api_index: int, error_str: str = ""):
+        """Открывает breaker пары с паузой по типу квоты."""
+        cooldown = quota_cooldown(error_str)
+        per_day = "PerDay" in error_str or "per day" in error_str.lower()
+        self.breaker(model_name, api_index).record_failure(cooldown, per_day)
+        self.quota(model_name, api_index).exhaust(per_day)
+        QUOTA_ERRORS.inc(model_name, f"#{api_index + 1}")
+        model_registry.drop(model_name, api_index)
+        print(f"⚠️ Лимит на {model_name} (API #{api_index + 1}), пауза {cooldown:.0f} с")
+    
+    def settle_usage(self, model_name: str, api_index: int, reserved: int, response):
+        """Заменяет оценку входных токенов на фактическую из usage_metadata."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None and usage.prompt_token_count:
+            self.quota(model_name, api_index).settle(reserved, usage.prompt_token_count)
+    
+    def quota_stats(self) -> Dict:
+        return {
+            f"{model_name}@#{api_index + 1}": quota.stats()
+            for (model_name, api_index), quota in self.quotas.items()
+        }
+    
+    def breaker_stats(self) -> Dict:
+        now = time.time()
+        for breaker in self.breakers.values():
+            breaker.available()  # open → half_open, если пауза истекла
+        return {
+            f"{model_name}@#{api_index + 1}": {
+                "state": breaker.state,
+                "retry_in_s": max(0, round(breaker.open_until - now)),
+            }
+            for (model_name, api_index), breaker in self.breakers.items()
+            if breaker.state != "closed"
+        }
+    
+    async def find_working_model(self) -> bool:
+        """
+        Поиск рабочей модели. Одновременные вызовы (пачка 429 от разных запросов)
+        ждут один общий поиск, а не запускают каждый свой веер проверок.
+        """
+        if self.search_task is None:
+            task = asyncio.create_task(self._find_working_model())
+            self.search_task = task
+            task.add_done_callback(lambda t: setattr(self, "search_task", None) if self.search_task is t else None)
+        # Отмена одного ждущего не должна отменять общий поиск
+        return await asyncio.shield(self.search_task)
+    
+    async def _find_working_model(self) -> bool:
         """
         Ищет рабочую модель по приоритету ТОЧНОСТИ.
         Сначала пробует самую точную модель на всех API,
         потом вторую по точности, потом третью и т.д.
         """
+        if MODEL_PROBE_PARALLEL:
+            return await self._find_working_model_parallel()
         
         # Пробуем каждую модель в порядке приоритета точности
         for model_name in MODEL_PRIORITY:
@@ -262,67 +1268,162 @@ class ModelManager:
                 if api_idx == self.api_key_index:
                     continue  # Уже пробовали
                 
-                # Переключаемся на другой API
-                self.api_key_index = api_idx
-                try:
-                    genai.configure(api_key=GOOGLE_KEYS[self.api_key_index])
-                    print(f"🔄 Переключился на API #{self.api_key_index + 1}")
-                    
-                    if await self._try_model(model_name, self.api_key_index):
+                print(f"🔄 Пробую API #{api_idx + 1}")
+                if await self._try_model(model_name, api_idx):
+                    return True
+        
+        print("❌ Не удалось найти рабочую модель на всех API и моделях")
+        return False
+    
+    async def _find_working_model_parallel(self) -> bool:
+        """
+        Проверяет все пары модель×ключ одновременно (не более MODEL_PROBE_FANOUT сразу).
+        Выбирает самую приоритетную модель, как только все более точные модели
+        ответили отказом, и отменяет оставшиеся проверки.
+        """
+        pairs = [
+            (priority, model_name, api_idx)
+            for priority, model_name in enumerate(MODEL_PRIORITY)
+            for api_idx in range(len(GOOGLE_KEYS))
+            if not self._is_limited(model_name, api_idx)
+        ]
+        if not pairs:
+            print("❌ Все пары модель×API в лимите")
+            return False
+        
+        print(f"\n🔍 Параллельная проверка {len(pairs)} пар модель×API...")
+        semaphore = asyncio.Semaphore(max(1, MODEL_PROBE_FANOUT))
+        
+        async def probe(model_name: str, api_idx: int):
+            async with semaphore:
+                return await self._probe_model(model_name, api_idx)
+        
+        tasks = {
+            asyncio.create_task(probe(model_name, api_idx)): (priority, model_name, api_idx)
+            for priority, model_name, api_idx in pairs
+        }
+        remaining = [0] * len(MODEL_PRIORITY)
+        for priority, _, _ in pairs:
+            remaining[priority] += 1
+        winners = {}  # {priority: (model_name, api_idx, model)}
+        
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    priority, model_name, api_idx = tasks[task]
+                    remaining[priority] -= 1
+                    model = task.result()
+                    if model is not None and priority not in winners:
+                        winners[priority] = (model_name, api_idx, model)
+                
+                # Победитель — первая модель, для которой все более точные уже отказали
+                for priority in range(len(MODEL_PRIORITY)):
+                    if priority in winners:
+                        model_name, api_idx, model = winners[priority]
+                        self._select(model_name, api_idx, model)
                         return True
-                except:
-                    pass
+                    if remaining[priority] > 0:
+                        break
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         
         print("❌ Не удалось найти рабочую модель на всех API и моделях")
         return False
     
+    def _select(self, model_name: str, api_index: int, model: genai.GenerativeModel):
+        """Делает пару модель×ключ текущей."""
+        if model_name != self.current_model_name:
+            model_registry.drop_except(model_name)
+            context_cache.release_except(model_name)
+            MODEL_SWITCHES.inc(model_name)
+        self.current_model = model
+        self.current_model_name = model_name
+        self.api_key_index = api_index
+        print(f"✅ Подключена модель: {model_name} на API #{api_index + 1}")
+    
     async def _try_model(self, model_name: str, api_index: int) -> bool:
         """Пробует одну модель на одном API ключе."""
+        model = await self._probe_model(model_name, api_index)
+        if model is None:
+            return False
+        self._select(model_name, api_index, model)
+        return True
+    
+    async def _probe_model(self, model_name: str, api_index: int) -> Optional[genai.GenerativeModel]:
+        """Тестовый запрос к модели на API ключе. Возвращает модель, если она отвечает."""
         
         # Проверяем, не в ли лимите эта модель на этом API
-        if self.model_limits.get(model_name, {}).get(api_index, False):
+        if self._is_limited(model_name, api_index):
             print(f"⏭️ Модель {model_name} уже в лимите на API #{api_index + 1}")
-            return False
+            return None
         
+        breaker = self.breaker(model_name, api_index)
+        breaker.begin()
+        self.quota(model_name, api_index).reserve(estimate_tokens(SYSTEM_PROMPT_GENERAL_MEDICINE))
         try:
-            test_model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                system_instruction=SYSTEM_PROMPT_GENERAL_MEDICINE
-            )
+            test_model = model_registry.get(model_name, "medicine_general", api_index)
             
-            # Быстрый тест
-            response = await test_model.generate_content_async("test")
+            # Быстрый тест (с таймаутом, чтобы медленный endpoint не тормозил переключение)
+            response = await asyncio.wait_for(
+                test_model.generate_content_async("test"),
+                timeout=MODEL_PROBE_TIMEOUT
+            )
             
             if response and response.text:
-                self.current_model = test_model
-                self.current_model_name = model_name
-                self.api_key_index = api_index
-                print(f"✅ Подключена модель: {model_name} на API #{api_index + 1}")
-                return True
+                breaker.record_success()
+                return test_model
+        
+        except asyncio.TimeoutError:
+            print(f"⏱️ Таймаут {model_name} (API #{api_index + 1})")
+        
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
         
         except Exception as e:
             error_str = str(e)
             
             # Если это лимит - отмечаем и переходим дальше
-            if "429" in error_str or "quota" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                if model_name not in self.model_limits:
-                    self.model_limits[model_name] = {}
-                self.model_limits[model_name][api_index] = True
-                print(f"⚠️ Лимит на {model_name} (API #{api_index + 1})")
-            else:
-                print(f"❌ Ошибка {model_name}: {error_str[:50]}")
+            if is_quota_error(error_str):
+                self.record_limit(model_name, api_index, error_str)
+                return None
+            print(f"❌ Ошибка {model_name}: {error_str[:50]}")
         
-        return False
+        # Таймаут, 404 и прочие отказы: пара тоже на паузе, иначе recovery_loop
+        # проверял бы её каждые MODEL_RECOVERY_INTERVAL (повторный отказ удваивает паузу)
+        breaker.record_failure(QUOTA_COOLDOWN_DEFAULT)
+        return None
     
-    async def handle_limit_error(self):
-        """Обрабатывает ошибку лимита - ищет альтернативу."""
-        print(f"\n⚠️ Текущая модель {self.current_model_name} (API #{self.api_key_index + 1}) в лимите!")
+    async def handle_limit_error(self, model_name: Optional[str] = None, api_index: Optional[int] = None,
+                                 error_str: str = ""):
+        """
+        Обрабатывает ошибку лимита пары модель×ключ.
+        Если у текущей модели остались здоровые ключи — продолжаем на них,
+        иначе ищем альтернативу.
+        """
+        model_name = model_name or self.current_model_name
+        if api_index is None:
+            # Ключ не занимали (все в лимите) — ни одна пара не падала, отмечать нечего
+            print(f"\n⚠️ У модели {model_name} нет свободных ключей!")
+        else:
+            print(f"\n⚠️ Модель {model_name} (API #{api_index + 1}) в лимите!")
+            # Отмечаем комбинацию как ограниченную (на время cooldown)
+            self.record_limit(model_name, api_index, error_str)
         
-        # Отмечаем текущую комбинацию как ограниченную
-        if self.current_model_name not in self.model_limits:
-            self.model_limits[self.current_model_name] = {}
-        self.model_limits[self.current_model_name][self.api_key_index] = True
+        # Другие ключи текущей модели ещё живы — переключение не нужно
+        if model_name == self.current_model_name and self.healthy_keys(model_name):
+            if self.api_key_index == api_index:
+                self.api_key_index = self.healthy_keys(model_name)[0]
+            return True
+        
+        # Пока мы ждали ответа, другой запрос уже переключил модель
+        if model_name != self.current_model_name and self.healthy_keys(self.current_model_name):
+            return True
         
         # Ищем альтернативу
         if await self.find_working_model():
@@ -330,6 +1431,151 @@ class ModelManager:
             return True
         
         return False
+    
+    async def try_upgrade(self) -> bool:
+        """
+        Пробует вернуться на более точную модель, у которой истекла пауза.
+        Пробный запрос (half-open) — один на пару.
+        """
+        if self.current_model_name not in MODEL_PRIORITY:
+            return False
+        current_priority = MODEL_PRIORITY.index(self.current_model_name)
+        for model_name in MODEL_PRIORITY[:current_priority]:
+            for api_idx in range(len(GOOGLE_KEYS)):
+                if self._is_limited(model_name, api_idx):
+                    continue
+                model = await self._probe_model(model_name, api_idx)
+                if model is not None:
+                    print(f"⬆️ Модель {model_name} восстановилась")
+                    self._select(model_name, api_idx, model)
+                    return True
+        return False
+    
+    @staticmethod
+    def _key_fingerprints() -> List[str]:
+        """Отпечатки ключей: снимок с другим набором ключей к этому пулу не относится."""
+        return [hashlib.sha256(key.encode()).hexdigest()[:12] for key in GOOGLE_KEYS]
+    
+    def snapshot(self) -> Dict:
+        """Состояние для тёплого старта: выбранная пара, breakers, дневные лимиты, задержки моделей."""
+        return {
+            "saved_at": time.time(),
+            "keys": self._key_fingerprints(),
+            "model": self.current_model_name if self.current_model is not None else None,
+            "api_index": self.api_key_index,
+            # open_until — по time.time(), поэтому паузы переживают перезапуск
+            "breakers": [
+                {"model": model_name, "api": api_index, "state": breaker.state,
+                 "open_until": breaker.open_until, "failures": breaker.failures}
+                for (model_name, api_index), breaker in self.breakers.items()
+                if breaker.state != "closed" or breaker.failures
+            ],
+            "day_usage": [
+                {"model": model_name, "api": api_index, "day": quota.day.isoformat(), "used": quota.day_used}
+                for (model_name, api_index), quota in self.quotas.items()
+                if quota.day is not None and quota.day_used
+            ],
+            "latency": {model_name: list(samples) for model_name, samples in hedger.samples.items()},
+        }
+    
+    def restore(self, data: Dict) -> bool:
+        """
+        Применяет снимок. True — текущая модель выбрана без проверочных запросов.
+        Из устаревшего снимка (старше MODEL_SNAPSHOT_MAX_AGE) берутся только ещё
+        действующие паузы и дневные счётчики, а модель ищется заново.
+        """
+        fresh = time.time() - data.get("saved_at", 0) <= MODEL_SNAPSHOT_MAX_AGE
+        for model_name, samples in data.get("latency", {}).items():
+            hedger.samples[model_name] = deque(samples, maxlen=hedger.window)
+        if data.get("keys") != self._key_fingerprints():
+            print("⏭️ Снимок моделей сделан для других API ключей")
+            return False
+        
+        def known(entry: Dict) -> bool:
+            return entry["model"] in MODEL_PRIORITY and 0 <= entry["api"] < len(GOOGLE_KEYS)
+        
+        now = time.time()
+        today = datetime.now(QUOTA_RESET_TZ).date().isoformat()
+        for entry in filter(known, data.get("breakers", [])):
+            if not fresh and entry["open_until"] <= now:
+                continue  # пауза давно истекла
+            breaker = self.breaker(entry["model"], entry["api"])
+            breaker.state = entry["state"]
+            breaker.open_until = entry["open_until"]
+            breaker.failures = entry["failures"]
+        for entry in filter(known, data.get("day_usage", [])):
+            if entry["day"] != today:
+                continue  # дневная квота с тех пор сбросилась
+            quota = self.quota(entry["model"], entry["api"])
+            quota.day = date.fromisoformat(entry["day"])
+            quota.day_used = entry["used"]
+        
+        if not fresh:
+            print("⏭️ Снимок моделей устарел: модель ищем заново, действующие лимиты учтены")
+            return False
+        model_name, api_index = data.get("model"), data.get("api_index", 0)
+        if model_name not in MODEL_PRIORITY or not 0 <= api_index < len(GOOGLE_KEYS):
+            return False
+        if self._is_limited(model_name, api_index):
+            healthy = self.healthy_keys(model_name)
+            if not healthy:
+                print(f"⏭️ {model_name} из снимка всё ещё в лимите")
+                return False
+            api_index = healthy[0]
+        self._select(model_name, api_index, model_registry.get(model_name, "medicine_general", api_index))
+        return True
+    
+    def save_snapshot(self, path: str = MODEL_SNAPSHOT_PATH):
+        if not path:
+            return
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)  # читатель не увидит недописанный файл
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить снимок моделей: {e}")
+    
+    def load_snapshot(self, path: str = MODEL_SNAPSHOT_PATH) -> bool:
+        """Тёплый старт из снимка. False — снимка нет или он не годится, нужен find_working_model."""
+        if not path or not os.path.exists(path):
+            return False
+        try:
+            with open(path, encoding="utf-8") as f:
+                return self.restore(json.load(f))
+        except Exception as e:
+            print(f"⚠️ Снимок моделей не прочитан: {e}")
+            return False
+    
+    async def verify_current(self):
+        """Фоновая проверка модели из снимка; не ответила — обычный поиск рабочей модели."""
+        model_name, api_index = self.current_model_name, self.api_key_index
+        if await self._probe_model(model_name, api_index) is not None:
+            print(f"✅ Модель из снимка отвечает: {model_name} (API #{api_index + 1})")
+            return
+        if self.current_model_name != model_name:
+            return  # пока шла проверка, запросы уже переключили модель
+        print(f"⚠️ Модель из снимка не отвечает: {model_name} (API #{api_index + 1})")
+        if not await self.find_working_model():
+            print("❌ Рабочая модель не найдена, продолжаю на модели из снимка")
+    
+    async def snapshot_loop(self):
+        """Периодическое сохранение снимка: перезапуск без остановки его тоже не потеряет."""
+        try:
+            while True:
+                await asyncio.sleep(MODEL_SNAPSHOT_INTERVAL)
+                self.save_snapshot()
+        finally:
+            self.save_snapshot()
+    
+    async def recovery_loop(self):
+        """Фоновая проверка: вернуться на более точную модель после сброса квоты."""
+        while True:
+            await asyncio.sleep(MODEL_RECOVERY_INTERVAL)
+            try:
+                await self.try_upgrade()
+            except Exception as e:
+                print(f"❌ Ошибка восстановления модели: {e}")
 
 model_manager = ModelManager()
 
@@ -337,25 +1583,357 @@ model_manager = ModelManager()
 # 📋 ИНИЦИАЛИЗАЦИЯ
 # ═══════════════════════════════════════════════════════════════
 
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+bot = Bot(
+    token=TOKEN,
+    default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None,
+)
 dp = Dispatcher()
 app = FastAPI()
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-USER_STATES = {}
+@dataclass(slots=True)
+class UserState:
+    """Состояние пользователя: режим и история диалога."""
+    user_id: int
+    mode: str = "medicine_general"
+    conversation_history: List[Dict] = field(default_factory=list)
+    summary: str = ""  # краткое содержание старой части диалога
+    last_activity: datetime = field(default_factory=lambda: datetime.now(MSK_TZ))
+    
+    def to_record(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "conversation_history": self.conversation_history,
+            "summary": self.summary,
+            "last_activity": self.last_activity.isoformat(),
+        }
+    
+    @classmethod
+    def from_record(cls, user_id: int, record: Dict) -> "UserState":
+        return cls(
+            user_id=user_id,
+            mode=record.get("mode", "medicine_general"),
+            conversation_history=record.get("conversation_history", []),
+            summary=record.get("summary", ""),
+            last_activity=datetime.fromisoformat(record["last_activity"]) if record.get("last_activity")
+            else datetime.now(MSK_TZ),
+        )
+
+# ═══════════════════════════════════════════════════════════════
+# 💽 ХРАНЕНИЕ СОСТОЯНИЙ
+# ═══════════════════════════════════════════════════════════════
+
+class StateBackend(abc.ABC):
+    """Интерфейс хранилища состояний. Записи — JSON-совместимые dict."""
+    name = "base"
+    
+    @abc.abstractmethod
+    async def load(self, user_id: int) -> Optional[Dict]:
+        ...
+    
+    @abc.abstractmethod
+    async def save_many(self, records: Dict[int, Dict]):
+        ...
+    
+    async def close(self):
+        pass
+
+class MemoryStateBackend(StateBackend):
+    """Хранилище в памяти процесса (тесты, запуск без диска)."""
+    name = "memory"
+    
+    def __init__(self):
+        self.records: Dict[int, Dict] = {}
+    
+    async def load(self, user_id: int) -> Optional[Dict]:
+        record = self.records.get(user_id)
+        return json.loads(json.dumps(record)) if record is not None else None
+    
+    async def save_many(self, records: Dict[int, Dict]):
+        for user_id, record in records.items():
+            self.records[user_id] = json.loads(json.dumps(record))
+
+class SQLiteStateBackend(StateBackend):
+    """SQLite в режиме WAL. Все обращения к базе — в отдельном потоке."""
+    name = "sqlite"
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_states ("
+                "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def _load(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM user_states WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _save_many(self, records: Dict[int, Dict]):
+        now = time.time()
+        rows = [(user_id, json.dumps(record, ensure_ascii=False), now) for user_id, record in records.items()]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT INTO user_states (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                rows
+            )
+            conn.commit()
+    
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    async def load(self, user_id: int) -> Optional[Dict]:
+        return await asyncio.to_thread(self._load, user_id)
+    
+    async def save_many(self, records: Dict[int, Dict]):
+        await asyncio.to_thread(self._save_many, records)
+    
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+def make_state_backend() -> StateBackend:
+    """Хранилище по USER_STATE_BACKEND."""
+    if USER_STATE_BACKEND == "memory":
+        return MemoryStateBackend()
+    return SQLiteStateBackend(USER_STATE_DB_PATH)
+
+class UserStateStore:
+    """
+    Ограниченное хранилище состояний (LRU по last_activity) поверх StateBackend.
+    Состояние загружается лениво при первом обращении; изменения пишутся
+    пакетами в фоне (write-behind). Больше max_users — вытесняется самый
+    давний; неактивные дольше idle_ttl выгружаются из памяти фоновым sweeper.
+    """
+    
+    def __init__(self, max_users: int, idle_ttl: float, backend: StateBackend):
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.backend = backend
+        self.states: "OrderedDict[int, UserState]" = OrderedDict()
+        self.dirty: Dict[int, UserState] = {}
+        self.evicted = 0
+        self.flushed = 0
+    
+    def __len__(self) -> int:
+        return len(self.states)
+    
+    async def get(self, user_id: int) -> UserState:
+        """Получает (лениво загружает) или создаёт состояние пользователя."""
+        state = self.states.get(user_id)
+        if state is None:
+            state = await self._load(user_id)
+            # Пока грузили, состояние мог создать параллельный запрос
+            state = self.states.setdefault(user_id, state)
+            while len(self.states) > self.max_users:
+                self.states.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.states.move_to_end(user_id)
+        state.last_activity = datetime.now(MSK_TZ)
+        self.mark_dirty(state)
+        return state
+    
+    async def _load(self, user_id: int) -> UserState:
+        # Вытесненное, но ещё не записанное состояние свежее, чем в базе
+        if user_id in self.dirty:
+            return self.dirty[user_id]
+        try:
+            record = await self.backend.load(user_id)
+        except Exception as e:
+            print(f"❌ Ошибка загрузки состояния {user_id}: {e}")
+            record = None
+        if record is None:
+            return UserState(user_id)
+        return UserState.from_record(user_id, record)
+    
+    def mark_dirty(self, state: UserState):
+        """Отмечает состояние для фоновой записи."""
+        self.dirty[state.user_id] = state
+    
+    async def flush(self):
+        """Записывает накопленные изменения одним пакетом."""
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        records = {user_id: state.to_record() for user_id, state in batch.items()}
+        try:
+            await self.backend.save_many(records)
+            self.flushed += len(records)
+        except Exception as e:
+            print(f"❌ Ошибка записи состояний: {e}")
+            # Возвращаем в очередь, если за это время не появилось более новое
+            for user_id, state in batch.items():
+                self.dirty.setdefault(user_id, state)
+    
+    async def flusher(self):
+        """Фоновая запись изменений (вне пути обработки запроса)."""
+        try:
+            while True:
+                await asyncio.sleep(USER_STATE_FLUSH_INTERVAL)
+                await self.flush()
+        finally:
+            await self.flush()
+    
+    async def close(self):
+        await self.flush()
+        await self.backend.close()
+    
+    def sweep(self) -> int:
+        """Выгружает из памяти пользователей, неактивных дольше idle_ttl."""
+        cutoff = datetime.now(MSK_TZ) - timedelta(seconds=self.idle_ttl)
+        removed = 0
+        # Порядок словаря = порядок активности, старые в начале
+        while self.states:
+            user_id, state = next(iter(self.states.items()))
+            if state.last_activity >= cutoff:
+                break
+            del self.states[user_id]
+            removed += 1
+        self.evicted += removed
+        return removed
+    
+    async def sweeper(self):
+        """Фоновая очистка неактивных пользователей."""
+        while True:
+            await asyncio.sleep(USER_STATE_SWEEP_INTERVAL)
+            removed = self.sweep()
+            if removed:
+                print(f"🧹 Удалено неактивных пользователей: {removed} (осталось {len(self)})")
+    
+    def memory_bytes(self) -> int:
+        """Примерный объём памяти состояний (записи + текст истории)."""
+        total = sys.getsizeof(self.states)
+        for state in self.states.values():
+            total += sys.getsizeof(state) + sys.getsizeof(state.conversation_history) + sys.getsizeof(state.summary)
+            for entry in state.conversation_history:
+                total += sum(sys.getsizeof(part) for part in entry["parts"])
+        return total
+    
+    def stats(self) -> Dict:
+        return {
+            "users": len(self.states),
+            "max_users": self.max_users,
+            "evicted": self.evicted,
+            "memory_kb": round(self.memory_bytes() / 1024, 1),
+            "backend": self.backend.name,
+            "pending_writes": len(self.dirty),
+            "flushed": self.flushed,
+        }
+
+user_store = UserStateStore(USER_STATE_MAX_USERS, USER_STATE_IDLE_TTL, make_state_backend())
 
-def get_user_state(user_id: int) -> Dict:
+async def get_user_state(user_id: int) -> UserState:
     """Получает или создаёт состояние пользователя."""
-    if user_id not in USER_STATES:
-        USER_STATES[user_id] = {
-            "mode": "medicine_general",
-            "conversation_history": [],
-            "last_activity": datetime.now(MSK_TZ)
+    return await user_store.get(user_id)
+
+# ═══════════════════════════════════════════════════════════════
+# 💾 КЭШ ОТВЕТОВ
+# ═══════════════════════════════════════════════════════════════
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к каноническому виду: регистр, ё, пунктуация, пробелы."""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+class AnswerCache:
+    """LRU-кэш ответов с TTL: {(вопрос, режим, модель): (ответ, время)}."""
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[str, str, str], Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Tuple[str, str, str]) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    def put(self, key: Tuple[str, str, str], answer: str):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (answer, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
         }
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+class SingleFlight:
+    """
+    Одинаковые первые вопросы, пришедшие, пока ответ ещё генерируется:
+    {(вопрос, режим, модель): future}. Первый запрос (ведущий) идёт в модель,
+    остальные ждут его ответ. В отличие от answer_cache, живёт только пока идёт вызов.
+    """
+    
+    def __init__(self):
+        self.flights: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+    
+    def join(self, key: Tuple[str, str, str]) -> Optional[asyncio.Future]:
+        """Future ведущего запроса или None — тогда этот запрос становится ведущим."""
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.followers += 1
+            SINGLEFLIGHT_REQUESTS.inc("follower")
+            return flight
+        self.flights[key] = asyncio.get_running_loop().create_future()
+        self.leaders += 1
+        SINGLEFLIGHT_REQUESTS.inc("leader")
+        return None
+    
+    def finish(self, key: Tuple[str, str, str], answer: Optional[str]):
+        """Отдаёт ответ ведущего ожидающим (None — ведущий не справился). Повторный вызов ничего не делает."""
+        flight = self.flights.pop(key, None)
+        if flight is not None and not flight.done():
+            flight.set_result(answer)
     
-    USER_STATES[user_id]["last_activity"] = datetime.now(MSK_TZ)
-    return USER_STATES[user_id]
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+singleflight = SingleFlight()
 
 # ═══════════════════════════════════════════════════════════════
 # 🎯 РАСШИРЕННЫЕ ТРИГГЕРЫ (ТОЧНОЕ СОВПАДЕНИЕ)
@@ -430,6 +2008,17 @@ def get_mode_buttons() -> InlineKeyboardMarkup:
     ])
     return keyboard
 
+BOT_USER: Optional[types.User] = None  # профиль бота: грузится один раз при старте
+
+async def get_bot_user() -> types.User:
+    """Профиль бота из памяти; запрос getMe — только если при старте его не получили."""
+    global BOT_USER
+    if BOT_USER is None:
+        with trace_span("get_me"):
+            BOT_USER = await bot.get_me()
+        print(f"🤖 Бот: @{BOT_USER.username} (id {BOT_USER.id})")
+    return BOT_USER
+
 async def is_addressed_to_bot(message: Message, bot_user: types.User) -> bool:
     """Проверяет, адресовано ли сообщение боту."""
     if message.chat.type == "private":
@@ -442,6 +2031,107 @@ async def is_addressed_to_bot(message: Message, bot_user: types.User) -> bool:
         return True
     return False
 
+class AddressedToBot(BaseFilter):
+    """
+    Пропускает в главный хендлер только то, на что бот должен ответить:
+    личку, обращения к боту в группе и сообщения с триггерами.
+    Остальной трафик групп отсекается до состояния, загрузки модели и сети.
+    Хендлер получает bot_user и trigger (действие или None).
+    """
+    
+    async def __call__(self, message: Message):
+        trigger = check_for_triggers(message.text or message.caption or "")
+        bot_user = await get_bot_user()
+        if trigger or await is_addressed_to_bot(message, bot_user):
+            return {"bot_user": bot_user, "trigger": trigger}
+        return False
+
+# ═══════════════════════════════════════════════════════════════
+# 🖼️ ОБРАБОТКА ИЗОБРАЖЕНИЙ
+# ═══════════════════════════════════════════════════════════════
+
+def pick_photo_size(photos: List[types.PhotoSize], target_side: int) -> types.PhotoSize:
+    """Наименьший вариант фото, у которого длинная сторона не меньше target_side."""
+    by_area = sorted(photos, key=lambda p: p.width * p.height)
+    for photo in by_area:
+        if max(photo.width, photo.height) >= target_side:
+            return photo
+    return by_area[-1]
+
+def preprocess_image(data: bytes, target_side: int, quality: int) -> bytes:
+    """Декодирует, уменьшает до target_side и пережимает в JPEG (выполняется в пуле потоков)."""
+    with Image.open(BytesIO(data)) as image:
+        image.draft("RGB", (target_side, target_side))  # для JPEG: декодирование сразу в уменьшенном виде
+        image = image.convert("RGB")
+        image.thumbnail((target_side, target_side), Image.LANCZOS)
+        out = BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+class ImagePipeline:
+    """Загрузка фото из Telegram и подготовка для Gemini вне event loop."""
+    
+    def __init__(self, target_side: int, quality: int, workers: int):
+        self.target_side = target_side
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self.images = 0
+        self.bytes_largest = 0     # сколько весил бы самый большой вариант фото
+        self.bytes_downloaded = 0
+        self.bytes_sent = 0
+        self.download_seconds = 0.0
+        self.process_seconds = 0.0
+    
+    async def load(self, photos: List[types.PhotoSize]) -> Dict:
+        """Скачивает подходящий размер фото и отдаёт JPEG-блоб для промта."""
+        photo = pick_photo_size(photos, self.target_side)
+        largest = photos[-1]
+        
+        trace = current_trace()
+        started = time.perf_counter()
+        file_info = await bot.get_file(photo.file_id)
+        img_data = BytesIO()
+        await bot.download_file(file_info.file_path, img_data)
+        raw = img_data.getvalue()
+        downloaded = time.perf_counter()
+        IMAGE_DOWNLOAD_SECONDS.observe(downloaded - started)
+        
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(
+            self.executor, preprocess_image, raw, self.target_side, self.quality
+        )
+        processed = time.perf_counter()
+        if trace is not None:
+            trace.add_span("photo_download", started, downloaded, bytes=len(raw))
+            trace.add_span("photo_process", downloaded, processed, bytes=len(data))
+        
+        largest_size = largest.file_size or len(raw)
+        self.images += 1
+        self.bytes_largest += largest_size
+        self.bytes_downloaded += len(raw)
+        self.bytes_sent += len(data)
+        self.download_seconds += downloaded - started
+        self.process_seconds += processed - downloaded
+        print(
+            f"🖼️ Фото {photo.width}×{photo.height} (из {largest.width}×{largest.height}): "
+            f"скачано {len(raw) // 1024} КБ за {downloaded - started:.2f} с, "
+            f"отправлено {len(data) // 1024} КБ (сэкономлено {(largest_size - len(data)) // 1024} КБ), "
+            f"обработка {processed - downloaded:.2f} с"
+        )
+        return {"mime_type": "image/jpeg", "data": data}
+    
+    def stats(self) -> Dict:
+        return {
+            "images": self.images,
+            "bytes_saved": self.bytes_largest - self.bytes_sent,
+            "kb_downloaded": self.bytes_downloaded // 1024,
+            "kb_sent": self.bytes_sent // 1024,
+            "avg_download_s": round(self.download_seconds / self.images, 3) if self.images else 0.0,
+            "avg_process_s": round(self.process_seconds / self.images, 3) if self.images else 0.0,
+        }
+
+image_pipeline = ImagePipeline(IMAGE_TARGET_SIDE, IMAGE_JPEG_QUALITY, IMAGE_WORKERS)
+
 async def prepare_prompt_parts(message: Message, bot_user: types.User) -> Tuple[List, List]:
     """Подготавливает части промта."""
     prompt_parts = []
@@ -459,136 +2149,923 @@ async def prepare_prompt_parts(message: Message, bot_user: types.User) -> Tuple[
     if message.photo:
         try:
             print(f"📸 Загружаю фото...")
-            photo_id = message.photo[-1].file_id
-            file_info = await bot.get_file(photo_id)
-            img_data = BytesIO()
-            await bot.download_file(file_info.file_path, img_data)
-            img_data.seek(0)
-            image = Image.open(img_data)
-            
-            prompt_parts.append(image)
+            prompt_parts.append(await image_pipeline.load(message.photo))
             print(f"✅ Фото добавлено")
         except Exception as e:
             print(f"❌ Ошибка фото: {e}")
     
     return prompt_parts, temp_files_to_delete
 
+class TelegramSender:
+    """
+    Исходящие сообщения с учётом лимитов Telegram:
+    ├─ общий темп бота — TELEGRAM_GLOBAL_RATE в секунду
+    ├─ темп чата — TELEGRAM_CHAT_RATE в секунду в личке, TELEGRAM_GROUP_RATE в минуту в группе
+    ├─ 429 → чат закрыт на retry_after секунд, потом повтор
+    └─ Markdown не разобрался → сразу то же самое простым текстом
+    """
+    
+    def __init__(self, global_rate: float, chat_rate: float, group_rate_per_min: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(max(1.0, global_rate), global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_min / 60
+        self.max_chats = max_chats
+        self.chats: Dict[int, TokenBucket] = {}
+        self.blocked_until: Dict[int, float] = {}
+        self.sent = 0
+        self.flood_waits = 0
+        self.plain_fallbacks = 0
+        self.skipped = 0
+    
+    def _chat_bucket(self, chat: types.Chat) -> TokenBucket:
+        bucket = self.chats.get(chat.id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                # Полные вёдра — чаты, куда давно не писали; их состояние не нужно
+                for chat_id in [cid for cid, b in self.chats.items() if b.level() >= b.capacity]:
+                    del self.chats[chat_id]
+            rate = self.chat_rate if chat.type == "private" else self.group_rate
+            bucket = TokenBucket(3, rate)  # небольшой всплеск, дальше — ровный темп
+            self.chats[chat.id] = bucket
+        return bucket
+    
+    async def _acquire(self, chat: types.Chat, wait: bool) -> bool:
+        bucket = self._chat_bucket(chat)
+        # Необязательная отправка оставляет в ведре токен под обязательную (финальную правку)
+        need = 1 if wait else 2
+        while True:
+            delay = max(
+                self.blocked_until.get(chat.id, 0.0) - time.monotonic(),
+                (need - bucket.level()) / bucket.rate,
+                (1 - self.global_bucket.level()) / self.global_bucket.rate,
+            )
+            if delay <= 0:
+                bucket.take(1)
+                self.global_bucket.take(1)
+                return True
+            if not wait:
+                return False
+            await asyncio.sleep(delay)
+    
+    async def send(self, chat: types.Chat, send, text: str, parse_mode=None,
+                   wait: bool = True, kind: str = "reply"):
+        """
+        send(text, parse_mode) — корутинная функция отправки или правки.
+        wait=False — не ждать лимитов (промежуточные правки, уведомления): вернёт None, если отправить сейчас нельзя.
+        """
+        # Попытки тратят только ожидания flood control; переход на простой текст — не попытка
+        flood_waits = 0
+        while True:
+            if not await self._acquire(chat, wait):
+                self.skipped += 1
+                return None
+            started = time.perf_counter()
+            try:
+                result = await send(text, parse_mode)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                self.blocked_until[chat.id] = time.monotonic() + e.retry_after
+                print(f"⏳ Flood control в чате {chat.id}: ждём {e.retry_after} с")
+                if not wait:
+                    self.skipped += 1
+                    return None
+                flood_waits += 1
+                if flood_waits >= TELEGRAM_SEND_ATTEMPTS:
+                    raise
+                continue
+            except TelegramBadRequest as e:
+                if parse_mode is None or "can't parse entities" not in str(e):
+                    raise
+                self.plain_fallbacks += 1
+                parse_mode = None
+                continue
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, kind)
+            self.sent += 1
+            return result
+    
+    async def reply(self, message: Message, text: str, parse_mode=None, wait: bool = True) -> Optional[Message]:
+        return await self.send(
+            message.chat, lambda t, pm: message.reply(t, parse_mode=pm), text, parse_mode, wait, "reply"
+        )
+    
+    async def edit(self, sent: Message, text: str, parse_mode=None, wait: bool = True):
+        return await self.send(
+            sent.chat, lambda t, pm: sent.edit_text(t, parse_mode=pm), text, parse_mode, wait, "edit"
+        )
+    
+    def stats(self) -> Dict:
+        return {
+            "sent": self.sent,
+            "flood_waits": self.flood_waits,
+            "plain_fallbacks": self.plain_fallbacks,
+            "skipped_edits": self.skipped,
+            "chats": len(self.chats),
+        }
+
+telegram_sender = TelegramSender(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE)
+
+def open_markdown(text: str) -> List[str]:
+    """Маркеры Markdown, которые открыты в конце текста (в порядке открытия)."""
+    stack = []
+    i = 0
+    while i < len(text):
+        if text.startswith("```", i):
+            if stack and stack[-1] == "```":
+                stack.pop()
+            elif not stack or stack[-1] != "`":
+                stack.append("```")
+            i += 3
+            continue
+        ch = text[i]
+        if stack and stack[-1] in ("```", "`"):
+            # Внутри кода разметки нет, ищем только закрывающую кавычку
+            if ch == "`" and stack[-1] == "`":
+                stack.pop()
+        elif ch == "\\":
+            i += 1
+        elif ch in "*_`":
+            following = text[i + 1:i + 2]
+            line_start = not text[text.rfind("\n", 0, i) + 1:i].strip()
+            if ch != "`" and line_start and (not following or following.isspace()):
+                pass  # пункт списка «* », а не разметка
+            elif stack and stack[-1] == ch:
+                stack.pop()
+            elif ch != "`" and (not following or following.isspace() or (ch == "_" and text[i - 1:i].isalnum())):
+                pass  # «a * b», snake_case — разметку так не открывают
+            else:
+                stack.append(ch)
+        i += 1
+    return stack
+
+def split_head(text: str, limit: int) -> Tuple[str, str]:
+    """
+    Отрезает от текста первую часть не длиннее limit: по абзацу, строке,
+    предложению, пробелу, в крайнем случае посреди слова. Незакрытая на разрезе
+    разметка закрывается в конце части и открывается в начале остатка.
+    """
+    if len(text) <= limit:
+        return text, ""
+    # Место под закрывающие маркеры
+    window = text[:limit - 8]
+    cut = -1
+    for separator in ("\n\n", "\n", ". ", " "):
+        position = window.rfind(separator)
+        if position > len(window) // 2:
+            cut = position + (1 if separator == ". " else 0)
+            break
+    if cut <= 0:
+        cut = len(window)
+    head, rest = text[:cut].rstrip(), text[cut:].lstrip()
+    
+    markers = open_markdown(head)
+    head += "".join("\n```" if m == "```" else m for m in reversed(markers))
+    rest = "".join("```\n" if m == "```" else m for m in markers) + rest
+    return head, rest
+
+def split_message(text: str, max_length: int = 4096) -> List[str]:
+    """Части для отправки; место под подпись «часть i/n» оставлено заранее."""
+    parts = []
+    rest = text.strip()
+    while rest:
+        head, rest = split_head(rest, max_length - 24)
+        if head.strip():
+            parts.append(head)
+    return parts
+
 async def send_long_message(message: Message, text: str, max_length: int = 4096):
-    """Отправляет длинное сообщение, разбивая его на части."""
+    """Отправляет длинное сообщение частями так быстро, как позволяют лимиты Telegram."""
     if len(text) <= max_length:
-        await message.reply(text, parse_mode=ParseMode.MARKDOWN)
+        await telegram_sender.reply(message, text, parse_mode=ParseMode.MARKDOWN)
         return
     
-    parts = []
-    current_part = ""
+    parts = split_message(text, max_length)
+    for i, part in enumerate(parts):
+        if i < len(parts) - 1:
+            part += f"\n\n_[часть {i + 1}/{len(parts)}]_"
+        await telegram_sender.reply(message, part, parse_mode=ParseMode.MARKDOWN)
+
+def chunk_text(chunk) -> str:
+    """Текст куска потокового ответа (служебные куски без частей → пустая строка)."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+class StreamingReply:
+    """
+    Ответ, который растёт по мере генерации.
+    Первый кусок отправляется сразу, дальше сообщение редактируется не чаще
+    STREAM_EDIT_INTERVAL. Заполненное сообщение закрывается, продолжение идёт в новое.
+    """
     
-    paragraphs = text.split("\n")
-    for paragraph in paragraphs:
-        if len(current_part) + len(paragraph) + 1 <= max_length:
-            current_part += paragraph + "\n"
-        else:
-            if current_part:
-                parts.append(current_part.strip())
-            current_part = paragraph + "\n"
+    def __init__(self, message: Message, max_length: int = 4096):
+        self.message = message
+        self.max_length = max_length
+        self.interval = STREAM_EDIT_INTERVAL if message.chat.type == "private" else STREAM_EDIT_INTERVAL_GROUP
+        self.full_text = ""
+        self.buffer = ""        # текст текущего (последнего) сообщения
+        self.shown = ""         # что сейчас видно в текущем сообщении
+        self.sent: Optional[Message] = None
+        self.last_edit = 0.0
     
-    if current_part:
-        parts.append(current_part.strip())
+    async def feed(self, text: str):
+        if not text:
+            return
+        self.full_text += text
+        self.buffer += text
+        
+        # Сообщение заполнилось — закрываем его и начинаем следующее
+        while len(self.buffer) > self.max_length:
+            head, self.buffer = split_head(self.buffer, self.max_length)
+            await self._show(head.strip(), final=True)
+            self.sent = None
+            self.shown = ""
+        
+        if self.sent is None or time.monotonic() - self.last_edit >= self.interval:
+            await self._show(self.buffer)
     
-    for i, part in enumerate(parts):
-        if part:
-            if i < len(parts) - 1:
-                await message.reply(part + "\n\n_[часть " + str(i+1) + "/" + str(len(parts)) + "]_", parse_mode=ParseMode.MARKDOWN)
-            else:
-                await message.reply(part, parse_mode=ParseMode.MARKDOWN)
-            
-            await asyncio.sleep(0.5)
+    async def finish(self):
+        """Финальная правка: полный текст с Markdown (или как есть, если разметка сломана)."""
+        if self.buffer.strip():
+            await self._show(self.buffer.strip(), final=True)
+    
+    async def interrupt(self):
+        """Генерацию отменили: помечаем оборванный ответ, чтобы его не приняли за полный."""
+        if self.sent is None or not self.buffer.strip():
+            return
+        marker = "\n\n⛔ Ответ прерван"
+        try:
+            await telegram_sender.edit(self.sent, self.buffer[:self.max_length - len(marker)] + marker, None, wait=False)
+        except Exception as e:
+            print(f"⚠️ Не удалось пометить прерванный ответ: {str(e)[:80]}")
+    
+    async def _show(self, text: str, final: bool = False):
+        if not text.strip():
+            return
+        # Промежуточные правки — без разметки: незакрытая * ломает Markdown.
+        # Промежуточную правку при упоре в лимит пропускаем, финальную — ждём.
+        parse_mode = ParseMode.MARKDOWN if final else None
+        try:
+            await self._send(text, parse_mode, wait=final)
+        except Exception as e:
+            if "not modified" in str(e):
+                return
+            print(f"⚠️ Ошибка потоковой правки: {str(e)[:80]}")
+    
+    async def _send(self, text: str, parse_mode, wait: bool):
+        if self.sent is None:
+            self.sent = await telegram_sender.reply(self.message, text, parse_mode)
+        elif text != self.shown or parse_mode is not None:
+            if await telegram_sender.edit(self.sent, text, parse_mode, wait=wait) is None:
+                return
+        self.shown = text
+        self.last_edit = time.monotonic()
 
-async def process_message(message: Message, bot_user: types.User, text_content: str, 
-                          prompt_parts: List, user_state: Dict):
-    """Обработка сообщения."""
+# ═══════════════════════════════════════════════════════════════
+# 🗜️ СЖАТИЕ ИСТОРИИ
+# ═══════════════════════════════════════════════════════════════
+
+_SUMMARY_TASKS: Dict[int, asyncio.Task] = {}
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов по длине текста."""
+    return int(len(text) / HISTORY_CHARS_PER_TOKEN) + 1
+
+def entry_tokens(entry: Dict) -> int:
+    return sum(estimate_tokens(part) for part in entry["parts"] if isinstance(part, str))
+
+def build_history_prompt(user_state: UserState) -> List[Dict]:
+    """История для запроса: краткое содержание (если есть) + последние реплики."""
+    history = []
+    if user_state.summary:
+        history.append({"role": "user", "parts": [f"Краткое содержание предыдущего диалога:\n{user_state.summary}"]})
+        history.append({"role": "model", "parts": ["Понял, учитываю этот контекст."]})
+    return history + user_state.conversation_history
+
+def compact_history(user_state: UserState):
+    """
+    Когда история превышает HISTORY_TOKEN_BUDGET, оставляет последние пары реплик
+    в пределах HISTORY_COMPACT_TARGET бюджета: сводка строится пачкой раз в
+    несколько ходов, а не отдельным вызовом модели на каждый ход.
+    Старые пары убираются сразу, а их краткое содержание готовится в фоне.
+    """
+    history = user_state.conversation_history
+    if sum(entry_tokens(entry) for entry in history) <= HISTORY_TOKEN_BUDGET:
+        return
+    target = HISTORY_TOKEN_BUDGET * HISTORY_COMPACT_TARGET
+    used = 0
+    keep_from = len(history)
+    # Идём с конца парами (user, model), чтобы история начиналась с user
+    for start in range(len(history) - 2, -1, -2):
+        pair_tokens = entry_tokens(history[start]) + entry_tokens(history[start + 1])
+        if used + pair_tokens > target and keep_from < len(history):
+            break
+        used += pair_tokens
+        keep_from = start
+    
+    overflow = history[:keep_from]
+    if not overflow:
+        return
+    user_state.conversation_history = history[keep_from:]
+    
+    previous = _SUMMARY_TASKS.get(user_state.user_id)
+    task = asyncio.create_task(summarize_overflow(user_state, overflow, previous))
+    _SUMMARY_TASKS[user_state.user_id] = task
+    task.add_done_callback(
+        lambda t: _SUMMARY_TASKS.pop(user_state.user_id, None) if _SUMMARY_TASKS.get(user_state.user_id) is t else None
+    )
+
+def reset_history(user_state: UserState):
+    """Очищает историю и сводку; незаконченная сводка старого диалога отменяется."""
+    task = _SUMMARY_TASKS.pop(user_state.user_id, None)
+    if task is not None:
+        task.cancel()  # ждущие её сводки отменяются вместе с ней через gather
+    user_state.conversation_history = []
+    user_state.summary = ""
+    user_store.mark_dirty(user_state)
+
+async def summarize_overflow(user_state: UserState, overflow: List[Dict], previous: Optional[asyncio.Task]):
+    """Сворачивает вытесненные реплики в user_state.summary (после отправки ответа)."""
+    if previous is not None:
+        # Сводки одного пользователя строятся по очереди
+        await asyncio.gather(previous, return_exceptions=True)
+    
+    dialogue = "\n".join(
+        f"{'Пользователь' if entry['role'] == 'user' else 'Ассистент'}: "
+        + " ".join(part for part in entry["parts"] if isinstance(part, str))
+        for entry in overflow
+    )
+    request = (
+        (f"Текущее краткое содержание:\n{user_state.summary}\n\n" if user_state.summary else "")
+        + f"Новые реплики:\n{dialogue}\n\nОбнови краткое содержание."
+    )
+    
+    tokens = estimate_tokens(SYSTEM_PROMPT_HISTORY_SUMMARY) + estimate_tokens(request)
+    model_name = model_manager.route(tokens)
+    api_index = None
+    summary = ""
     try:
-        if user_state["mode"] == "medicine_general":
-            system_prompt = SYSTEM_PROMPT_GENERAL_MEDICINE
-            mode_name = "🏥 Общая медицина"
-        elif user_state["mode"] == "medicine_gynecology":
-            system_prompt = SYSTEM_PROMPT_GYNECOLOGY
-            mode_name = "👶 Гинекология"
-        else:  # obstetrics
-            system_prompt = SYSTEM_PROMPT_OBSTETRICS
-            mode_name = "🤰 Акушерство"
-        
-        print(f"\n📨 Запрос от {message.from_user.id} [{mode_name}]")
-        print(f"   Модель: {model_manager.current_model_name} (API #{model_manager.api_key_index + 1})")
-        
-        conversation_history = user_state["conversation_history"]
-        
-        current_model = genai.GenerativeModel(
-            model_name=model_manager.current_model_name,
-            generation_config=generation_config,
-            system_instruction=system_prompt
-        )
+        async with model_manager.lease_key(model_name, tokens) as api_index:
+            if api_index is not None:
+                model = model_registry.get(model_name, "history_summary", api_index)
+                # Зависший вызов держал бы ключ и все следующие сводки пользователя
+                async with asyncio.timeout(MODEL_CALL_TIMEOUT or None):
+                    response = await model.generate_content_async(request)
+                model_manager.settle_usage(model_name, api_index, tokens, response)
+                summary = response.text.strip()
+    except Exception as e:
+        error_str = str(e)
+        if isinstance(e, TimeoutError):
+            MODEL_TIMEOUTS.inc(model_name)
+            error_str = f"Model call timed out after {MODEL_CALL_TIMEOUT:.0f}s"
+        if is_quota_error(error_str) and api_index is not None:
+            model_manager.record_limit(model_name, api_index, error_str)
+        print(f"⚠️ Не удалось сжать историю {user_state.user_id}: {error_str[:80]}")
+    
+    if not summary:
+        # Запасной вариант без модели: просто хвост старого диалога
+        summary = (user_state.summary + "\n" + dialogue).strip()[-HISTORY_SUMMARY_MAX_CHARS:]
+    
+    user_state.summary = summary[:HISTORY_SUMMARY_MAX_CHARS]
+    user_store.mark_dirty(user_state)
+    print(f"🗜️ История {user_state.user_id} сжата: {len(overflow)} реплик → {len(user_state.summary)} символов")
+
+# ═══════════════════════════════════════════════════════════════
+# 🏁 ВЫЗОВ МОДЕЛИ И ДУБЛИРУЮЩИЕ ЗАПРОСЫ
+# ═══════════════════════════════════════════════════════════════
+
+class NoKeyAvailable(RuntimeError):
+    """У модели нет ни одного ключа вне лимита: ни одна пара не падала, отмечать нечего."""
+
+class ModelCall:
+    """
+    Один вызов модели в отдельной задаче: занимает ключ, отправляет запрос,
+    складывает куски ответа в очередь. Отмена задачи освобождает ключ.
+    """
+    
+    def __init__(self, model_name: str, mode: str, prompt: List, tokens: int, heavy: bool,
+                 exclude: Optional[int] = None):
+        self.model_name = model_name
+        self.api_index: Optional[int] = None
+        self.cached_content: Optional[str] = None
+        self.response = None
+        self.failed = False          # упал, не выдав ни одного куска
+        self.ready = asyncio.Event()  # первый кусок, конец или ошибка
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.started = time.perf_counter()
+        self.task = asyncio.create_task(self._run(mode, prompt, tokens, heavy, exclude))
+    
+    async def _run(self, mode: str, prompt: List, tokens: int, heavy: bool, exclude: Optional[int]):
+        try:
+            async with model_manager.lease_key(self.model_name, tokens, heavy, exclude) as api_index:
+                if api_index is None:
+                    raise NoKeyAvailable(f"Все ключи в лимите для {self.model_name}")
+                self.api_index = api_index
+                print(f"   Модель: {self.model_name} (API #{api_index + 1})")
+                
+                if context_cache.enabled:
+                    with trace_span("context_cache"):
+                        self.cached_content = await context_cache.lookup(self.model_name, mode, api_index)
+                model = model_registry.get(self.model_name, mode, api_index, self.cached_content)
+                
+                if STREAM_ANSWERS:
+                    self.response = await model.generate_content_async(prompt, stream=True)
+                    async for chunk in self.response:
+                        self._emit(chunk_text(chunk))
+                else:
+                    self.response = await model.generate_content_async(prompt)
+                    self._emit(self.response.text)
+            self.queue.put_nowait(None)
+        except Exception as e:
+            self.failed = not self.ready.is_set()
+            self.queue.put_nowait(e)
+        finally:
+            self.ready.set()
+    
+    def _emit(self, text: str):
+        if not text:
+            return
+        if not self.ready.is_set():
+            hedger.observe(self.model_name, time.perf_counter() - self.started)
+            self.ready.set()
+        self.queue.put_nowait(text)
+    
+    async def chunks(self, timeout: Optional[float] = None):
+        """
+        Куски ответа по мере поступления; ошибка вызова пробрасывается.
+        timeout — сколько всего можно ждать модель; время обработки кусков не в счёт.
+        """
+        while True:
+            if not self.queue.empty():
+                item = self.queue.get_nowait()
+            else:
+                waited = time.monotonic()
+                async with asyncio.timeout(timeout):
+                    item = await self.queue.get()
+                if timeout is not None:
+                    timeout -= time.monotonic() - waited
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def cancel(self):
+        self.task.cancel()
+
+class Hedger:
+    """
+    Дублирующие запросы (HEDGE_REQUESTS=1). Если основной вызов не выдал ни куска
+    за p95 времени до первого куска этой модели, тот же запрос уходит на другой
+    ключ или следующую модель; берём того, кто ответит первым, второй отменяем.
+    Дублей — не больше HEDGE_MAX_SHARE от всех запросов.
+    """
+    
+    def __init__(self, enabled: bool, max_share: float, min_delay: float, default_delay: float, window: int):
+        self.enabled = enabled
+        self.max_share = max_share
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.capped = 0
+    
+    def observe(self, model_name: str, seconds: float):
+        self.samples.setdefault(model_name, deque(maxlen=self.window)).append(seconds)
+    
+    def threshold(self, model_name: str) -> float:
+        samples = self.samples.get(model_name)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return self.default_delay
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[int(len(ordered) * 0.95) - 1])
+    
+    async def race(self, primary: ModelCall, mode: str, prompt: List, tokens: int) -> ModelCall:
+        """Возвращает вызов, чей ответ идёт пользователю (проигравший уже отменён)."""
+        self.requests += 1
+        if not self.enabled:
+            return primary
         
-        if conversation_history:
-            full_prompt = conversation_history + [{"role": "user", "parts": prompt_parts}]
-        else:
-            full_prompt = [{"role": "user", "parts": prompt_parts}]
+        waiter = asyncio.create_task(primary.ready.wait())
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=self.threshold(primary.model_name))
+        finally:
+            waiter.cancel()
+        if done:
+            return primary
         
-        response = await current_model.generate_content_async(full_prompt)
+        if self.hedged + 1 > self.max_share * self.requests:
+            self.capped += 1
+            return primary
+        target = model_manager.hedge_target(primary.model_name, primary.api_index, tokens)
+        if target is None:
+            return primary
         
-        if response.text:
-            print(f"✅ Ответ получен ({len(response.text)} символов)")
-            
-            user_state["conversation_history"].append({
-                "role": "user",
-                "parts": [text_content]
-            })
-            user_state["conversation_history"].append({
-                "role": "model",
-                "parts": [response.text]
-            })
-            
-            if len(user_state["conversation_history"]) > 20:
-                user_state["conversation_history"] = user_state["conversation_history"][-20:]
-            
-            answer_text = response.text
-            await send_long_message(message, answer_text)
-            print(f"✅ Ответ отправлен")
+        self.hedged += 1
+        exclude = primary.api_index if target == primary.model_name else None
+        print(f"🏁 Дубль запроса: {target} (основной {primary.model_name} молчит)")
+        hedge = ModelCall(target, mode, prompt, tokens, True, exclude)
+        try:
+            with trace_span("hedge", model=target):
+                winner = await self._first_ready([primary, hedge])
+        except BaseException:
+            # Таймаут или отмена генерации: основной вызов отменит вызывающий, дубль — здесь
+            hedge.cancel()
+            raise
+        (hedge if winner is primary else primary).cancel()
+        if winner is hedge:
+            self.hedge_wins += 1
+        HEDGES.inc("hedge" if winner is hedge else "primary")
+        return winner
+    
+    @staticmethod
+    async def _first_ready(calls: List[ModelCall]) -> ModelCall:
+        """Первый вызов, выдавший кусок; упавший ждёт, пока не закончится другой."""
+        pending = list(calls)
+        while True:
+            waiters = {asyncio.create_task(call.ready.wait()): call for call in pending}
+            try:
+                done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+            ready = [waiters[waiter] for waiter in done]
+            for call in ready:
+                if not call.failed:
+                    return call
+            pending = [call for call in pending if call not in ready]
+            if not pending:
+                return calls[0]  # упали оба — отдаём ошибку основного
+    
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "capped": self.capped,
+            "thresholds_s": {model: round(self.threshold(model), 2) for model in self.samples},
+        }
+
+hedger = Hedger(HEDGE_REQUESTS, HEDGE_MAX_SHARE, HEDGE_MIN_DELAY, HEDGE_DEFAULT_DELAY, HEDGE_WINDOW)
+
+class RetryPolicy:
+    """
+    Повторы вызова модели для одного вопроса:
+    ├─ quota — пара в лимите: handle_limit_error и сразу на другую пару
+    ├─ no_key — свободного ключа нет: поиск другой модели без отметки лимита
+    ├─ transient — 5xx, таймаут: экспоненциальная пауза с jitter
+    ├─ stale_cache — кэш промта пропал: повтор с инлайн-промтом
+    └─ permanent — остальное: без повторов
+    Не больше max_attempts попыток и не дольше deadline секунд на вопрос.
+    """
+    
+    TRANSIENT = re.compile(
+        r"\b(500|502|503|504)\b|internal|unavailable|deadline|timed? ?out|overloaded|connection reset",
+        re.IGNORECASE
+    )
+    
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float, deadline: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+    
+    def classify(self, error: Exception, error_str: str, cached_content: Optional[str] = None) -> str:
+        if isinstance(error, NoKeyAvailable):
+            return "no_key"
+        if is_quota_error(error_str):
+            return "quota"
+        if cached_content and "cache" in error_str.lower() and ContextCache.is_missing_error(error_str):
+            return "stale_cache"
+        if self.TRANSIENT.search(error_str):
+            return "transient"
+        return "permanent"
+    
+    def delay(self, attempt: int, kind: str) -> float:
+        if kind in ("quota", "no_key", "stale_cache"):
+            # Следующая попытка идёт на другую пару или без кэша — долго ждать незачем
+            return random.uniform(0, self.base_delay / 2)
+        # Full jitter: случайная пауза до экспоненциального потолка
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+    
+    def allows(self, attempt: int, kind: str, deadline: float, delay: float) -> bool:
+        return (
+            kind != "permanent"
+            and attempt < self.max_attempts
+            and time.monotonic() + delay < deadline
+        )
+
+retry_policy = RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_DEADLINE)
+
+class GenerationRegistry:
+    """
+    Текущая генерация ответа пользователя в чате: {(chat_id, user_id): task}.
+    Новое сообщение в том же чате, /refresh или смена режима отменяют устаревшую
+    генерацию сразу и выкидывают ещё не начатые вопросы из очереди — они не
+    тратят квоту и не пишут ответ в уже очищенную историю.
+    Вопрос, на который пользователь ещё ничего не увидел, при новом сообщении
+    не теряется: его сообщения склеиваются с новым. Готовый ответ, который
+    уже отправляется, новое сообщение не прерывает.
+    """
+    
+    def __init__(self):
+        self.tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.questions: Dict[asyncio.Task, List[Message]] = {}  # ответа ещё не видно
+        self.delivering: set = set()
+    
+    def track(self, chat_id: int, user_id: int, messages: List[Message]) -> asyncio.Task:
+        task = asyncio.current_task()
+        self.tasks[(chat_id, user_id)] = task
+        self.questions[task] = messages
+        return task
+    
+    def shown(self):
+        """Часть ответа уже у пользователя — вопрос больше не переносится в следующий."""
+        self.questions.pop(asyncio.current_task(), None)
+    
+    def deliver(self):
+        """Ответ готов и отправляется: новое сообщение его не отменяет."""
+        task = asyncio.current_task()
+        self.questions.pop(task, None)
+        self.delivering.add(task)
+    
+    def release(self, chat_id: int, user_id: int, task: asyncio.Task):
+        if self.tasks.get((chat_id, user_id)) is task:
+            del self.tasks[(chat_id, user_id)]
+        self.questions.pop(task, None)
+        self.delivering.discard(task)
+    
+    def cancel(self, user_id: int, reason: str, chat_id: Optional[int] = None) -> int:
+        """
+        Отменяет генерации пользователя в чате chat_id (None — во всех чатах:
+        режим и история у пользователя общие). Возвращает число отменённых.
+        """
+        superseded = reason == "superseded"
+        restored = []
+        cancelled = 0
+        for key in [key for key in self.tasks if key[1] == user_id and chat_id in (None, key[0])]:
+            task = self.tasks[key]
+            if superseded and task in self.delivering:
+                continue  # ответ уже отправляется — новый вопрос подождёт его в очереди
+            del self.tasks[key]
+            if task.done() or task is asyncio.current_task():
+                continue
+            if superseded:
+                restored.extend(self.questions.get(task, []))
+            task.cancel()
+            cancelled += 1
+        dropped = scheduler.drop(user_id, chat_id)
+        cancelled += len(dropped)
+        if superseded:
+            # Старый вопрос идёт в модель вместе с новым, а не пропадает
+            restored.extend(message for messages in dropped if messages for message in messages)
+            if restored:
+                coalescer.restore(restored)
+        if cancelled:
+            GENERATIONS_CANCELLED.inc(reason, amount=cancelled)
+            print(f"⛔ Генерации для {user_id} отменены ({reason}): {cancelled}")
+        return cancelled
+    
+    def stats(self) -> Dict:
+        return {
+            "running": len(self.tasks),
+            "delivering": len(self.delivering),
+            "cancelled": {labels[0]: int(count) for labels, count in GENERATIONS_CANCELLED.values.items()},
+            "timeouts": int(sum(MODEL_TIMEOUTS.values.values())),
+        }
+
+generations = GenerationRegistry()
+
+async def process_message(message: Message, bot_user: types.User, text_content: str, 
+                          prompt_parts: List, user_state: UserState):
+    """Обработка сообщения: вызов модели с повторами по retry_policy и отправка ответа."""
+    mode = user_state.mode if user_state.mode in MODE_PROMPTS else "medicine_obstetrics"
+    mode_name = MODE_NAMES[mode]
+    conversation_history = build_history_prompt(user_state)
+    
+    # Оценка входных токенов: по ней запрос заранее уходит на пару с запасом по лимитам
+    images = sum(1 for p in prompt_parts if not isinstance(p, str))
+    tokens = (
+        estimate_tokens(MODE_PROMPTS[mode])
+        + sum(entry_tokens(entry) for entry in conversation_history)
+        + sum(estimate_tokens(p) for p in prompt_parts if isinstance(p, str))
+        + images * QUOTA_IMAGE_TOKENS
+    )
+    heavy = images > 0 or tokens > QUOTA_HEAVY_TOKENS
+    
+    # Кэшируем только первый вопрос без истории и без картинок
+    question_key = None
+    if not user_state.conversation_history and not user_state.summary and all(isinstance(p, str) for p in prompt_parts):
+        question_key = normalize_question(" ".join(prompt_parts))
+        cached_answer = answer_cache.get((question_key, mode, model_manager.route(tokens, heavy)))
+        if cached_answer:
+            print(f"💾 Ответ из кэша для {message.from_user.id} [{mode_name}]")
+            generations.deliver()
+            with trace_span("telegram_send", cached=True):
+                await send_long_message(message, cached_answer)
+            user_state.conversation_history.append({"role": "user", "parts": [text_content]})
+            user_state.conversation_history.append({"role": "model", "parts": [cached_answer]})
+            user_store.mark_dirty(user_state)
             return True
-        
-        else:
-            await message.reply("⚠️ Пустой ответ от модели")
-            return False
     
-    except Exception as e:
-        error_str = str(e)
-        print(f"❌ Ошибка: {error_str[:100]}")
+    # Такой же вопрос уже в работе — ждём его ответ вместо своего вызова модели
+    flight_key = None
+    if question_key and SINGLEFLIGHT:
+        flight_key = (question_key, mode, model_manager.route(tokens, heavy))
+        flight = singleflight.join(flight_key)
+        if flight is not None:
+            flight_key = None
+            with trace_span("singleflight_wait"):
+                shared_answer = await asyncio.shield(flight)
+            if shared_answer:
+                print(f"🤝 Ответ общего запроса для {message.from_user.id} [{mode_name}]")
+                generations.deliver()
+                with trace_span("telegram_send", shared=True):
+                    await send_long_message(message, shared_answer)
+                user_state.conversation_history.append({"role": "user", "parts": [text_content]})
+                user_state.conversation_history.append({"role": "model", "parts": [shared_answer]})
+                user_store.mark_dirty(user_state)
+                return True
+            # Ведущий запрос не получил ответа — пробуем сами
+    
+    print(f"\n📨 Запрос от {message.from_user.id} [{mode_name}]")
+    
+    # Промт собирается один раз: текст и уже обработанное фото идут во все попытки
+    if conversation_history:
+        full_prompt = conversation_history + [{"role": "user", "parts": prompt_parts}]
+    else:
+        full_prompt = [{"role": "user", "parts": prompt_parts}]
+    
+    try:
+        deadline = time.monotonic() + retry_policy.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            # Пара модель×ключ этой попытки — чтобы при 429 отметить именно её
+            model_name = model_manager.route(tokens, heavy)
+            api_index = None
+            call = None
+            stream_reply = None
+            started = time.perf_counter()
+            stream_busy = 0.0  # сколько из попытки ушло на правки в Telegram
+            stream_started = None
+            try:
+                # Попытка ограничена и своим таймаутом, и общим сроком вопроса
+                timeout = deadline - time.monotonic()
+                if MODEL_CALL_TIMEOUT:
+                    timeout = min(timeout, MODEL_CALL_TIMEOUT)
+                span = {"model": model_name, "stream": STREAM_ANSWERS, "attempt": attempt}
+                try:
+                    # Под таймаутом только ожидание модели; отправка в Telegram (лимиты чата) не в счёт
+                    waited = time.monotonic()
+                    async with asyncio.timeout(timeout):
+                        call = ModelCall(model_name, mode, full_prompt, tokens, heavy)
+                        call = await hedger.race(call, mode, full_prompt, tokens)
+                    model_budget = timeout - (time.monotonic() - waited)
+                    if STREAM_ANSWERS:
+                        stream_reply = StreamingReply(message)
+                        async for text in call.chunks(model_budget):
+                            fed = time.perf_counter()
+                            if stream_started is None:
+                                stream_started = fed
+                            await stream_reply.feed(text)
+                            stream_busy += time.perf_counter() - fed
+                            if stream_reply.sent is not None:
+                                generations.shown()
+                        answer_text = stream_reply.full_text
+                    else:
+                        answer_text = "".join([text async for text in call.chunks(model_budget)])
+                    response = call.response
+                    # Дубль мог выиграть на другой паре — дальше работаем с ней
+                    model_name, api_index = call.model_name, call.api_index
+                    span.update(model=model_name, api=api_index + 1)
+                finally:
+                    # Правки в Telegram — своя фаза, в model_call только ожидание модели
+                    record_span("model_call", started, time.perf_counter() - stream_busy, **span)
+                    if stream_started is not None:
+                        record_span("telegram_stream", stream_started, stream_started + stream_busy)
+                # Латентность модели — только ожидание её кусков, без отправки в Telegram
+                model_seconds = time.perf_counter() - started - stream_busy
+                break
         
-        if "429" in error_str or "quota" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-            print(f"⚠️ Лимит текущей модели!")
+            except Exception as e:
+                if call is not None:
+                    model_name, api_index = call.model_name, call.api_index
+                error_str = str(e)
+                if isinstance(e, TimeoutError):
+                    MODEL_TIMEOUTS.inc(model_name)
+                    error_str = f"Model call timed out after {timeout:.0f}s"
+                kind = retry_policy.classify(e, error_str, call.cached_content if call else None)
+                print(f"❌ Ошибка ({kind}, попытка {attempt}): {error_str[:100]}")
+                if api_index is not None:
+                    MODEL_REQUESTS.inc(model_name, f"#{api_index + 1}", "quota" if kind == "quota" else "error")
             
-            # Ищем альтернативу
-            if await model_manager.handle_limit_error():
-                print(f"✅ Пробую снова с {model_manager.current_model_name}")
-                return await process_message(message, bot_user, text_content, prompt_parts, user_state)
+                if kind == "stale_cache":
+                    context_cache.invalidate(model_name, mode, api_index)
+                elif kind in ("quota", "no_key"):
+                    with trace_span("handle_limit_error", model=model_name):
+                        recovered = await model_manager.handle_limit_error(model_name, api_index, error_str)
+                    if not recovered:
+                        await telegram_sender.reply(
+                            message,
+                            "❌ Все лимиты исчерпаны на данный момент.\n"
+                            "Модели вернутся автоматически после сброса квоты.\n"
+                            "Попробуйте позже! 🕐"
+                        )
+                        return False
             
-            await message.reply(
-                "❌ Все лимиты исчерпаны на данный момент.\n"
-                "Лимиты обновляются каждые 24 часа.\n"
-                "Попробуйте позже! 🕐"
-            )
-            return False
+                # Часть ответа уже у пользователя — повтор продублировал бы её
+                shown = stream_reply is not None and bool(stream_reply.full_text)
+                delay = retry_policy.delay(attempt, kind)
+                if shown or not retry_policy.allows(attempt, kind, deadline, delay):
+                    await telegram_sender.reply(message, f"❌ Ошибка: {error_str[:100]}")
+                    return False
+            
+                RETRIES.inc(kind)
+                print(f"🔁 Повтор через {delay:.1f} с (на {model_manager.route(tokens, heavy)})")
+                with trace_span("retry_backoff", kind=kind):
+                    await asyncio.sleep(delay)
         
-        else:
-            await message.reply(f"❌ Ошибка: {error_str[:100]}")
-            return False
+            except asyncio.CancelledError:
+                # Генерацию отменили (новый вопрос, /refresh, смена режима)
+                if stream_reply is not None:
+                    await stream_reply.interrupt()
+                raise
+            
+            finally:
+                # Ответ не дочитан (ошибка, отмена) — вызов модели не должен висеть
+                if call is not None:
+                    call.cancel()
+    
+        
+        if flight_key:
+            singleflight.finish(flight_key, answer_text)
+    finally:
+        # Ошибка или отмена — ожидающие не должны висеть
+        if flight_key:
+            singleflight.finish(flight_key, None)
+    
+    api_label = f"#{api_index + 1}"
+    MODEL_CALL_SECONDS.observe(model_seconds, model_name, api_label, mode)
+    MODEL_REQUESTS.inc(model_name, api_label, "ok")
+    record_usage(model_name, response)
+    model_manager.settle_usage(model_name, api_index, tokens, response)
+    
+    if not answer_text:
+        await telegram_sender.reply(message, "⚠️ Пустой ответ от модели")
+        return False
+    
+    print(f"✅ Ответ получен ({len(answer_text)} символов)")
+    
+    if question_key:
+        answer_cache.put((question_key, mode, model_name), answer_text)
+    
+    # Квота потрачена, ответ готов — новое сообщение в чате его уже не отменяет
+    generations.deliver()
+    try:
+        with trace_span("telegram_send"):
+            if stream_reply:
+                await stream_reply.finish()
+            else:
+                await send_long_message(message, answer_text)
+    except asyncio.CancelledError:
+        # /refresh или смена режима посреди отправки: ответ оборван и в историю не идёт
+        if stream_reply is not None:
+            await stream_reply.interrupt()
+        raise
+    print(f"✅ Ответ отправлен")
+    
+    # В историю — только ответ, который пользователь получил целиком
+    user_state.conversation_history.append({
+        "role": "user",
+        "parts": [text_content]
+    })
+    user_state.conversation_history.append({
+        "role": "model",
+        "parts": [answer_text]
+    })
+    
+    user_store.mark_dirty(user_state)
+    
+    # Сжатие истории — уже после отправки ответа
+    compact_history(user_state)
+    return True
 
 async def handle_trigger_action(message: Message, action: str, bot_user: types.User):
     """Обрабатывает триггер-действие."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
+    if action == "refresh":
+        generations.cancel(user_id, "refresh")
+    elif action in ("doctor", "gynecology", "obstetrics"):
+        generations.cancel(user_id, "mode")
     
     if action == "doctor":
-        user_state["mode"] = "medicine_general"
+        user_state.mode = "medicine_general"
         await message.answer(
             "🏥 *Общая медицина* ✅\n\n"
             "Готов анализировать кардиологию, инфекции, пульмологию и др.\n\n"
@@ -597,7 +3074,7 @@ async def handle_trigger_action(message: Message, action: str, bot_user: types.U
         print(f"✅ {message.from_user.first_name} выбрал ОБЩУЮ МЕДИЦИНУ")
     
     elif action == "gynecology":
-        user_state["mode"] = "medicine_gynecology"
+        user_state.mode = "medicine_gynecology"
         await message.answer(
             "👶 *Гинекология* ✅\n\n"
             "Готов анализировать репродуктивную медицину и ВРТ.\n\n"
@@ -606,7 +3083,7 @@ async def handle_trigger_action(message: Message, action: str, bot_user: types.U
         print(f"✅ {message.from_user.first_name} выбрал ГИНЕКОЛОГИЮ")
     
     elif action == "obstetrics":
-        user_state["mode"] = "medicine_obstetrics"
+        user_state.mode = "medicine_obstetrics"
         await message.answer(
             "🤰 *Акушерство* ✅\n\n"
             "Готов анализировать беременность, роды и послеродовой период.\n\n"
@@ -623,7 +3100,7 @@ async def handle_trigger_action(message: Message, action: str, bot_user: types.U
         await command_start_handler(message)
     
     elif action == "refresh":
-        user_state["conversation_history"] = []
+        reset_history(user_state)
         await message.answer(
             "🗑️ *История очищена* ✅\n\n"
             "Начинаем диалог с чистого листа!"
@@ -638,12 +3115,14 @@ async def handle_trigger_action(message: Message, action: str, bot_user: types.U
 async def handle_mode_callback(query: CallbackQuery):
     """Обработка переключения режимов."""
     user_id = query.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
     
     callback_data = query.data
+    if callback_data.startswith("mode_"):
+        generations.cancel(user_id, "mode")
     
     if callback_data == "mode_general":
-        user_state["mode"] = "medicine_general"
+        user_state.mode = "medicine_general"
         message_text = (
             "🏥 *Общая медицина*\n\n"
             "Кардиология, инфекции, пульмология, гастроэнтерология, эндокринология и др.\n\n"
@@ -653,7 +3132,7 @@ async def handle_mode_callback(query: CallbackQuery):
         )
         
     elif callback_data == "mode_gyn":
-        user_state["mode"] = "medicine_gynecology"
+        user_state.mode = "medicine_gynecology"
         message_text = (
             "👶 *Гинекология*\n\n"
             "Репродуктивная медицина, менструальные расстройства, ВРТ, беременность\n\n"
@@ -663,7 +3142,7 @@ async def handle_mode_callback(query: CallbackQuery):
         )
     
     elif callback_data == "mode_aku":
-        user_state["mode"] = "medicine_obstetrics"
+        user_state.mode = "medicine_obstetrics"
         message_text = (
             "🤰 *Акушерство*\n\n"
             "Беременность, роды, послеродовой период, перинатальная помощь\n\n"
@@ -738,7 +3217,7 @@ INFO_TEXT = """🏥 *МЕДИЦИНСКИЙ АССИСТЕНТ V5.0*
 async def command_start_handler(message: Message):
     """Стартовое сообщение."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
     
     api_info = f" (API #{model_manager.api_key_index + 1}/{len(GOOGLE_KEYS)})"
     status = f"✅ `{model_manager.current_model_name}`{api_info}" if model_manager.current_model_name != "Searching..." else "💀 Модель загружается..."
@@ -767,8 +3246,9 @@ async def command_info_handler(message: Message):
 async def command_medic_handler(message: Message):
     """Включить режим общей медицины."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
-    user_state["mode"] = "medicine_general"
+    user_state = await get_user_state(user_id)
+    generations.cancel(user_id, "mode")
+    user_state.mode = "medicine_general"
     
     await message.answer(
         "🏥 *Общая медицина* ✅\n\n"
@@ -780,8 +3260,9 @@ async def command_medic_handler(message: Message):
 async def command_gen_handler(message: Message):
     """Включить режим гинекологии."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
-    user_state["mode"] = "medicine_gynecology"
+    user_state = await get_user_state(user_id)
+    generations.cancel(user_id, "mode")
+    user_state.mode = "medicine_gynecology"
     
     await message.answer(
         "👶 *Гинекология* ✅\n\n"
@@ -793,8 +3274,9 @@ async def command_gen_handler(message: Message):
 async def command_aku_handler(message: Message):
     """Включить режим акушерства."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
-    user_state["mode"] = "medicine_obstetrics"
+    user_state = await get_user_state(user_id)
+    generations.cancel(user_id, "mode")
+    user_state.mode = "medicine_obstetrics"
     
     await message.answer(
         "🤰 *Акушерство* ✅\n\n"
@@ -806,8 +3288,9 @@ async def command_aku_handler(message: Message):
 async def command_refresh_handler(message: Message):
     """Очистить память диалога."""
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
-    user_state["conversation_history"] = []
+    user_state = await get_user_state(user_id)
+    generations.cancel(user_id, "refresh")
+    reset_history(user_state)
     
     await message.answer("🗑️ *История очищена*\n\nНачинаем с чистого листа!")
 
@@ -815,48 +3298,74 @@ async def command_refresh_handler(message: Message):
 # 🔥 ГЛАВНЫЙ ХЕНДЛЕР
 # ═══════════════════════════════════════════════════════════════
 
-@dp.message()
-async def main_handler(message: Message):
-    """Главный обработчик сообщений."""
-    user_id = message.from_user.id
-    user_state = get_user_state(user_id)
-    
-    text_to_check = message.text or message.caption or ""
-    trigger_result = check_for_triggers(text_to_check)
-    
-    if trigger_result:
-        bot_user = await bot.get_me()
-        await handle_trigger_action(message, trigger_result, bot_user)
-        return
-    
-    if not model_manager.current_model:
-        status_msg = await message.answer("⏳ Загрузка модели...")
-        if not await model_manager.find_working_model():
-            await status_msg.edit_text("❌ Не удалось загрузить модель. Проверьте API ключи.")
+@dp.message(AddressedToBot())
+async def main_handler(message: Message, bot_user: types.User, trigger: Optional[str]):
+    """Главный обработчик сообщений (неадресованное в группах отсеяно фильтром)."""
+    trace = start_trace("update", chat_id=message.chat.id, user_id=message.from_user.id, chat_type=message.chat.type)
+    handed_off = False
+    try:
+        if trigger:
+            with trace_span("trigger", action=trigger):
+                await handle_trigger_action(message, trigger, bot_user)
             return
-        try:
-            await status_msg.delete()
-        except:
-            pass
-    
-    bot_user = await bot.get_me()
-    is_addressed = await is_addressed_to_bot(message, bot_user)
-    
-    if not is_addressed:
-        return
-    
-    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+        
+        if not model_manager.current_model:
+            status_msg = await message.answer("⏳ Загрузка модели...")
+            with trace_span("find_working_model"):
+                found = await model_manager.find_working_model()
+            if not found:
+                await status_msg.edit_text("❌ Не удалось загрузить модель. Проверьте API ключи.")
+                return
+            try:
+                await status_msg.delete()
+            except:
+                pass
+        
+        # Новый вопрос делает ещё не готовый ответ на предыдущий ненужным
+        generations.cancel(message.from_user.id, "superseded", message.chat.id)
+        # Серия быстрых сообщений уйдёт в модель одним запросом; трасса продолжится там
+        coalescer.submit(message)
+        handed_off = True
+    finally:
+        if not handed_off:
+            finish_trace(trace)
+
+async def handle_message_batch(messages: List[Message]):
+    """Обрабатывает одно или несколько склеенных сообщений как один вопрос."""
+    message = messages[-1]  # отвечаем на последнее сообщение серии
+    user_id = message.from_user.id
+    task = generations.track(message.chat.id, user_id, messages)
     
     try:
-        text_content = ""
-        if message.text:
-            text_content = message.text.replace(f"@{bot_user.username}", "").strip()
-        elif message.caption:
-            text_content = message.caption.replace(f"@{bot_user.username}", "").strip()
+        # Состояние создаём только для сообщений, адресованных боту
+        with trace_span("load_state"):
+            user_state = await get_user_state(user_id)
+        REQUESTS_BY_MODE.inc(user_state.mode)
+        bot_user = await get_bot_user()
         
-        print(f"\n📨 Новый запрос от {user_id}: {text_content[:60]}...")
+        with trace_span("typing"):
+            await bot.send_chat_action(chat_id=message.chat.id, action="typing")
         
-        prompt_parts, temp_files_to_delete = await prepare_prompt_parts(message, bot_user)
+        prompt_parts = []
+        with trace_span("prepare_prompt", messages=len(messages)):
+            for part_message in messages:
+                parts, _ = await prepare_prompt_parts(part_message, bot_user)
+                prompt_parts.extend(parts)
+        
+        texts = [p for p in prompt_parts if isinstance(p, str)]
+        text_content = "\n".join(texts)
+        # Подряд идущие тексты склеиваем в один, картинки оставляем на своих местах
+        merged_parts = []
+        for part in prompt_parts:
+            if isinstance(part, str) and merged_parts and isinstance(merged_parts[-1], str):
+                merged_parts[-1] += "\n" + part
+            else:
+                merged_parts.append(part)
+        prompt_parts = merged_parts
+        
+        if len(messages) > 1:
+            print(f"\n🧩 Склеено {len(messages)} сообщений от {user_id}")
+        print(f"\n📨 Новый запрос от {user_id}: {text_content[:60]}...")
         
         if not prompt_parts:
             await message.reply("⚠️ Не найден текст или изображение")
@@ -866,7 +3375,224 @@ async def main_handler(message: Message):
     
     except Exception as e:
         logging.error(f"Main Handler Error: {e}")
-        await message.reply(f"❌ Ошибка: {str(e)[:100]}")
+        await telegram_sender.reply(message, f"❌ Ошибка: {str(e)[:100]}")
+    finally:
+        generations.release(message.chat.id, user_id, task)
+
+class MessageCoalescer:
+    """
+    Склеивает сообщения одного пользователя в одном чате, пришедшие
+    с паузой меньше окна, в один запрос к модели и один ответ.
+    """
+    
+    def __init__(self, window_ms: int, max_messages: int, handler):
+        self.window = window_ms / 1000
+        self.max_messages = max_messages
+        self.handler = handler
+        self.pending: Dict[Tuple[int, int], List[Message]] = {}
+        self.timers: Dict[Tuple[int, int], asyncio.Task] = {}
+        # Трасса первого сообщения серии и время его прихода
+        self.traces: Dict[Tuple[int, int], Tuple[Optional[Trace], float]] = {}
+    
+    def submit(self, message: Message):
+        key = (message.chat.id, message.from_user.id)
+        self.pending.setdefault(key, []).append(message)
+        if key in self.traces:
+            finish_trace(current_trace())  # трасса этого сообщения поглощается трассой серии
+        else:
+            self.traces[key] = (current_trace(), time.perf_counter())
+        
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        
+        # Окно 0 или серия слишком длинная — обрабатываем без ожидания
+        delay = 0 if len(self.pending[key]) >= self.max_messages else self.window
+        self.timers[key] = asyncio.create_task(self._flush_later(key, delay))
+    
+    def restore(self, messages: List[Message]):
+        """
+        Возвращает сообщения вытесненного вопроса в начало серии: они уйдут
+        в модель вместе с новым сообщением, которое следом придёт в submit.
+        """
+        key = (messages[0].chat.id, messages[0].from_user.id)
+        self.pending[key] = messages + self.pending.get(key, [])
+    
+    async def _flush_later(self, key: Tuple[int, int], delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # С этого момента новые сообщения начинают новую серию и не отменяют обработку
+        self.timers.pop(key, None)
+        messages = self.pending.pop(key, [])
+        trace, submitted = self.traces.pop(key, (None, 0.0))
+        use_trace(trace)
+        if trace is not None:
+            trace.add_span("coalesce_wait", submitted, messages=len(messages))
+        if messages:
+            await self.handler(messages)
+
+# ═══════════════════════════════════════════════════════════════
+# 🚦 ОЧЕРЕДЬ ЗАПРОСОВ
+# ═══════════════════════════════════════════════════════════════
+
+class RequestScheduler:
+    """
+    Допуск запросов к модели:
+    ├─ общий лимит одновременных запросов (SCHEDULER_SLOTS_PER_KEY на здоровый ключ)
+    ├─ не больше одного запроса в работе на пользователя
+    ├─ round-robin по чатам, внутри чата — по пользователям
+    └─ при глубокой очереди — сообщение о позиции или отказ
+    """
+    
+    def __init__(self, slots_per_key: int, max_queue: int):
+        self.slots_per_key = slots_per_key
+        self.max_queue = max_queue
+        # {chat_id: {user_id: deque[job]}} — порядок словарей задаёт очередь обхода
+        self.queues: "OrderedDict[int, OrderedDict[int, deque]]" = OrderedDict()
+        self.queued = 0
+        self.running = 0
+        self.active_users = set()
+        self.rejected = 0
+        self._tasks = set()
+    
+    def capacity(self) -> int:
+        healthy = len(model_manager.healthy_keys(model_manager.current_model_name)) or len(GOOGLE_KEYS)
+        return max(1, healthy * self.slots_per_key)
+    
+    async def submit(self, message: Message, job, on_drop=None) -> bool:
+        """
+        Ставит job (корутинную функцию без аргументов) в очередь. False — очередь переполнена.
+        on_drop() вызывается, если задание выкинуто из очереди, не начавшись (drop);
+        его результат drop() возвращает вызывающему.
+        """
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            await telegram_sender.reply(message, "⏳ Сейчас слишком много запросов. Попробуйте через минуту 🙏", wait=False)
+            return False
+        
+        chat_id, user_id = message.chat.id, message.from_user.id
+        users = self.queues.setdefault(chat_id, OrderedDict())
+        users.setdefault(user_id, deque()).append((job, on_drop))
+        self.queued += 1
+        self._dispatch()
+        
+        # Не стартовал сразу — сообщаем позицию
+        position = self.position(chat_id, user_id)
+        if position >= SCHEDULER_NOTIFY_POSITION:
+            try:
+                await telegram_sender.reply(message, f"⏳ Запрос в очереди, позиция {position}", wait=False)
+            except Exception as e:
+                print(f"⚠️ Не удалось сообщить позицию: {e}")
+        return True
+    
+    def position(self, chat_id: int, user_id: int) -> int:
+        """Примерная позиция последнего запроса пользователя (0 — уже в работе)."""
+        jobs = self.queues.get(chat_id, {}).get(user_id)
+        if not jobs:
+            return 0
+        # Round-robin: впереди примерно по столько же запросов от каждого другого пользователя
+        depth = len(jobs)
+        ahead = sum(
+            min(len(other_jobs), depth)
+            for users in self.queues.values()
+            for other_id, other_jobs in users.items()
+            if other_id != user_id
+        )
+        return ahead + depth
+    
+    def _next_job(self):
+        """Следующий запрос по кругу: чат → пользователь, пропуская занятых пользователей."""
+        for chat_id in list(self.queues):
+            users = self.queues[chat_id]
+            for user_id in list(users):
+                if user_id in self.active_users:
+                    continue
+                jobs = users[user_id]
+                job, _ = jobs.popleft()
+                # Обслуженные чат и пользователь уходят в конец круга
+                if jobs:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                if users:
+                    self.queues.move_to_end(chat_id)
+                else:
+                    del self.queues[chat_id]
+                return user_id, job
+        return None
+    
+    def _dispatch(self):
+        while self.running < self.capacity():
+            picked = self._next_job()
+            if picked is None:
+                return
+            user_id, job = picked
+            self.queued -= 1
+            self.running += 1
+            self.active_users.add(user_id)
+            task = asyncio.create_task(self._run(user_id, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, user_id: int, job):
+        try:
+            await job()
+        except Exception as e:
+            logging.error(f"Scheduler job error: {e}")
+        finally:
+            self.running -= 1
+            self.active_users.discard(user_id)
+            self._dispatch()
+    
+    def drop(self, user_id: int, chat_id: Optional[int] = None) -> List:
+        """
+        Выкидывает ещё не начатые задания пользователя (в чате chat_id или во всех).
+        Возвращает то, что вернули их on_drop, по порядку очереди.
+        """
+        dropped = []
+        for queue_chat_id in [chat_id] if chat_id is not None else list(self.queues):
+            users = self.queues.get(queue_chat_id)
+            if not users or user_id not in users:
+                continue
+            for _, on_drop in users.pop(user_id):
+                dropped.append(on_drop() if on_drop is not None else None)
+            if not users:
+                del self.queues[queue_chat_id]
+        self.queued -= len(dropped)
+        return dropped
+    
+    def stats(self) -> Dict:
+        return {
+            "running": self.running,
+            "capacity": self.capacity(),
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+scheduler = RequestScheduler(SCHEDULER_SLOTS_PER_KEY, SCHEDULER_MAX_QUEUE)
+
+async def enqueue_message_batch(messages: List[Message]):
+    """Склеенная серия сообщений идёт в модель через очередь."""
+    trace = current_trace()
+    queued_at = time.perf_counter()
+    
+    async def job():
+        use_trace(trace)
+        if trace is not None:
+            trace.add_span("queue_wait", queued_at)
+        try:
+            await handle_message_batch(messages)
+        finally:
+            finish_trace(trace)
+    
+    def dropped() -> List[Message]:
+        finish_trace(trace)
+        return messages
+    
+    if not await scheduler.submit(messages[-1], job, on_drop=dropped):
+        finish_trace(trace)
+
+coalescer = MessageCoalescer(COALESCE_WINDOW_MS, COALESCE_MAX_MESSAGES, enqueue_message_batch)
 
 # ═══════════════════════════════════════════════════════════════
 # 🌐 WEB SERVER
@@ -879,9 +3605,41 @@ async def root():
         "bot_type": "Medical Assistant V5.0",
         "model": model_manager.current_model_name,
         "api_key": f"#{model_manager.api_key_index + 1}/{len(GOOGLE_KEYS)}",
-        "active_users": len(USER_STATES),
+        "key_pool": key_pool.stats(),
+        "limited_pairs": model_manager.breaker_stats(),
+        "answer_cache": answer_cache.stats(),
+        "context_cache": context_cache.stats(),
+        "quotas": model_manager.quota_stats(),
+        "hedging": hedger.stats(),
+        "telegram_sender": telegram_sender.stats(),
+        "singleflight": singleflight.stats(),
+        "generations": generations.stats(),
+        "images": image_pipeline.stats(),
+        "scheduler": scheduler.stats(),
+        "active_users": len(user_store),
+        "user_states": user_store.stats(),
+        "process_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
     }
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/traces")
+async def debug_traces(request: Request, format: str = "json"):
+    """
+    Самые медленные запросы. format=chrome — для chrome://tracing / Perfetto.
+    В трассах id пользователей и чатов, поэтому только с DEBUG_TOKEN в X-Debug-Token.
+    """
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(request.headers.get("X-Debug-Token", ""), DEBUG_TOKEN):
+        raise HTTPException(status_code=403)
+    traces = slow_traces.slowest()
+    if format == "chrome":
+        return {"traceEvents": [event for trace in traces for event in trace.to_chrome_events()]}
+    return {"finished": slow_traces.finished, "traces": [trace.to_dict() for trace in traces]}
+
 @app.get("/health")
 async def health_check():
     return {
@@ -890,6 +3648,23 @@ async def health_check():
         "model_name": model_manager.current_model_name,
     }
 
+_WEBHOOK_TASKS = set()
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    """Приём апдейтов от Telegram: быстрый 200, обработка — в фоне."""
+    if BOT_MODE != "webhook":
+        raise HTTPException(status_code=404)
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        raise HTTPException(status_code=403)
+    
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    _WEBHOOK_TASKS.add(task)
+    task.add_done_callback(_WEBHOOK_TASKS.discard)
+    return {"ok": True}
+
 async def keep_alive_ping():
     """Пингует сервер для keep-alive."""
     if not RENDER_URL:
@@ -904,7 +3679,7 @@ async def keep_alive_ping():
             pass
 
 async def start_bot():
-    """Запуск бота в polling режиме."""
+    """Запуск бота (polling или webhook по BOT_MODE)."""
     print(f"\n{'='*60}")
     print(f"🚀 ЗАПУСК МЕДИЦИНСКОГО АССИСТЕНТА V5.0")
     print(f"{'='*60}")
@@ -914,10 +3689,35 @@ async def start_bot():
     print(f"\n🔑 Доступно API ключей: {len(GOOGLE_KEYS)}")
     
     print(f"\n🔍 Инициализирую модель...")
-    if not await model_manager.find_working_model():
+    if model_manager.load_snapshot():
+        # Отвечаем сразу; модель из снимка проверяется в фоне
+        print(f"♻️ Тёплый старт из {MODEL_SNAPSHOT_PATH}")
+        model_manager.verify_task = asyncio.create_task(model_manager.verify_current())
+    elif not await model_manager.find_working_model():
         print(f"⚠️ Не удалось загрузить модель, но продолжаю работу...")
     
     print(f"✅ Модель: {model_manager.current_model_name} (API #{model_manager.api_key_index + 1})")
+    
+    try:
+        await get_bot_user()
+    except Exception as e:
+        print(f"⚠️ Не удалось получить профиль бота, запрошу при первом сообщении: {e}")
+    
+    if BOT_MODE == "webhook":
+        if not RENDER_URL:
+            print("❌ BOT_MODE=webhook требует RENDER_EXTERNAL_URL")
+            return
+        webhook_url = f"{RENDER_URL.rstrip('/')}{WEBHOOK_PATH}"
+        print(f"🤖 Запуск бота в webhook режиме: {webhook_url}\n")
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        # Апдейты приходят в telegram_webhook; работаем, пока жив веб-сервер
+        await asyncio.Event().wait()
+        return
+    
     print(f"🤖 Запуск бота в polling режиме...\n")
     
     await bot.delete_webhook(drop_pending_updates=True)
@@ -935,19 +3735,30 @@ async def main():
         print("❌ ОШИБКА: Google API ключи не установлены!")
         sys.exit(1)
     
-    # Инициализируем первый API ключ
-    try:
-        genai.configure(api_key=GOOGLE_KEYS[model_manager.api_key_index])
-        print(f"✅ API #{model_manager.api_key_index + 1} сконфигурирован")
-    except Exception as e:
-        print(f"❌ Ошибка конфигурации API: {e}")
-        sys.exit(1)
+    # Каждый ключ получает свой клиент в key_pool — глобальный genai.configure не нужен
+    print(f"✅ Пул API ключей: {len(GOOGLE_KEYS)}")
     
-    await asyncio.gather(
-        start_server(),
-        start_bot(),
-        keep_alive_ping(),
-    )
+    background = [
+        asyncio.create_task(keep_alive_ping()),
+        asyncio.create_task(model_manager.recovery_loop()),
+        asyncio.create_task(user_store.sweeper()),
+        asyncio.create_task(user_store.flusher()),
+        asyncio.create_task(model_manager.snapshot_loop()),
+    ]
+    try:
+        # Бот и сервер останавливаются по сигналу — после этого сохраняем состояние
+        await asyncio.wait(
+            [asyncio.create_task(start_server()), asyncio.create_task(start_bot())],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await user_store.close()
+        print("💾 Состояния пользователей сохранены")
+        if MODEL_SNAPSHOT_PATH:
+            print(f"💾 Снимок моделей сохранён в {MODEL_SNAPSHOT_PATH}")
 
 if __name__ == "__main__":
     try:
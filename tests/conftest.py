@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Конфигурация бота читается при импорте — окружение задаём до него
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test-token")
+os.environ.setdefault("GOOGLE_API_KEY", "test-key-1")
+os.environ["USER_STATE_BACKEND"] = "memory"
+os.environ["MODEL_SNAPSHOT_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
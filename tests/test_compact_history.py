@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import medical_bot_main as bot_main
+from medical_bot_main import UserState, compact_history, entry_tokens, reset_history
+
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """Подменяет вызов модели в сводке: записывает вытесненные реплики."""
+    calls = []
+
+    async def fake_summarize(user_state, overflow, previous):
+        calls.append(overflow)
+        await asyncio.sleep(0.05)
+        user_state.summary = "СВОДКА старого диалога"
+
+    monkeypatch.setattr(bot_main, "HISTORY_TOKEN_BUDGET", 1000)
+    monkeypatch.setattr(bot_main, "HISTORY_COMPACT_TARGET", 0.5)
+    monkeypatch.setattr(bot_main, "summarize_overflow", fake_summarize)
+    return calls
+
+
+def add_turn(state, answer_chars):
+    state.conversation_history.append({"role": "user", "parts": ["вопрос"]})
+    state.conversation_history.append({"role": "model", "parts": ["о" * answer_chars]})
+
+
+def history_tokens(state):
+    return sum(entry_tokens(entry) for entry in state.conversation_history)
+
+
+def test_history_within_budget_is_untouched(summaries):
+    async def scenario():
+        state = UserState(user_id=1)
+        add_turn(state, 300)
+        compact_history(state)
+        return state
+
+    state = asyncio.run(scenario())
+    assert len(state.conversation_history) == 2
+    assert summaries == []
+
+
+def test_overflow_compacts_down_to_target(summaries):
+    async def scenario():
+        state = UserState(user_id=1)
+        for _ in range(4):
+            add_turn(state, 900)  # ~300 токенов на пару
+        compact_history(state)
+        await asyncio.sleep(0.1)
+        return state
+
+    state = asyncio.run(scenario())
+    assert history_tokens(state) <= 500
+    assert state.conversation_history[0]["role"] == "user"
+    assert len(summaries) == 1
+    assert state.summary == "СВОДКА старого диалога"
+
+
+def test_summaries_come_in_batches(summaries):
+    async def scenario():
+        state = UserState(user_id=1)
+        for _ in range(10):
+            add_turn(state, 900)
+            compact_history(state)
+            await asyncio.sleep(0.06)
+
+    asyncio.run(scenario())
+    assert 0 < len(summaries) <= 5
+
+
+def test_last_pair_is_kept_even_over_budget(summaries):
+    async def scenario():
+        state = UserState(user_id=1)
+        add_turn(state, 6000)
+        compact_history(state)
+        return state
+
+    state = asyncio.run(scenario())
+    assert len(state.conversation_history) == 2
+
+
+def test_refresh_discards_pending_summary(summaries):
+    async def scenario():
+        state = UserState(user_id=1)
+        for _ in range(4):
+            add_turn(state, 900)
+        compact_history(state)
+        reset_history(state)
+        await asyncio.sleep(0.1)
+        return state
+
+    state = asyncio.run(scenario())
+    assert state.summary == ""
+    assert state.conversation_history == []
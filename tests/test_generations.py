@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import medical_bot_main as bot_main
+from medical_bot_main import GenerationRegistry, MessageCoalescer
+
+
+def make_message(text, chat_id=10, user_id=1):
+    return SimpleNamespace(text=text, chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=user_id))
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """Свой склейщик с коротким окном: записывает серии, ушедшие в обработку."""
+    handled = []
+
+    async def handler(messages):
+        handled.append([message.text for message in messages])
+
+    monkeypatch.setattr(bot_main, "coalescer", MessageCoalescer(20, 10, handler))
+    return handled
+
+
+def run_generation(registry, messages, *steps):
+    async def generation():
+        registry.track(10, 1, messages)
+        for step in steps:
+            getattr(registry, step)()
+        await asyncio.sleep(10)
+    return asyncio.create_task(generation())
+
+
+def test_superseded_question_is_merged_with_new_one(batches):
+    async def scenario():
+        registry = GenerationRegistry()
+        task = run_generation(registry, [make_message("Пациентка 32 г., 12 нед.")])
+        await asyncio.sleep(0)
+        assert registry.cancel(1, "superseded", 10) == 1
+        bot_main.coalescer.submit(make_message("какой скрининг?"))
+        await asyncio.sleep(0.05)
+        return task
+
+    task = asyncio.run(scenario())
+    assert task.cancelled()
+    assert batches == [["Пациентка 32 г., 12 нед.", "какой скрининг?"]]
+
+
+def test_shown_answer_is_not_merged(batches):
+    async def scenario():
+        registry = GenerationRegistry()
+        run_generation(registry, [make_message("первый")], "shown")
+        await asyncio.sleep(0)
+        registry.cancel(1, "superseded", 10)
+        bot_main.coalescer.submit(make_message("второй"))
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert batches == [["второй"]]
+
+
+def test_delivering_answer_survives_new_message_but_not_refresh(batches):
+    async def scenario():
+        registry = GenerationRegistry()
+        task = run_generation(registry, [make_message("вопрос")], "deliver")
+        await asyncio.sleep(0)
+        assert registry.cancel(1, "superseded", 10) == 0
+        await asyncio.sleep(0)
+        assert not task.done()
+        assert registry.cancel(1, "refresh") == 1
+        await asyncio.sleep(0)
+        return task
+
+    assert asyncio.run(scenario()).cancelled()
+    assert batches == []
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+
+import medical_bot_main as bot_main
+from medical_bot_main import MODEL_PRIORITY, ModelManager
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(bot_main, "MODEL_SNAPSHOT_MAX_AGE", 3600)
+    return ModelManager()
+
+
+def snapshot(saved_ago: float, open_for: float) -> dict:
+    now = time.time()
+    return {
+        "saved_at": now - saved_ago,
+        "keys": ModelManager._key_fingerprints(),
+        "model": MODEL_PRIORITY[1],
+        "api_index": 0,
+        "breakers": [
+            {"model": MODEL_PRIORITY[0], "api": 0, "state": "open", "open_until": now + open_for, "failures": 2},
+        ],
+        "day_usage": [
+            {"model": MODEL_PRIORITY[1], "api": 0,
+             "day": datetime.now(bot_main.QUOTA_RESET_TZ).date().isoformat(), "used": 17},
+            {"model": MODEL_PRIORITY[2], "api": 0, "day": "2000-01-01", "used": 99},
+        ],
+        "latency": {MODEL_PRIORITY[1]: [0.4, 0.5]},
+    }
+
+
+def test_fresh_snapshot_selects_model_without_probes(manager):
+    async def scenario():
+        # Клиент gRPC создаётся в работающем цикле, как в start_bot
+        return manager.restore(snapshot(saved_ago=60, open_for=600))
+
+    assert asyncio.run(scenario())
+    assert manager.current_model_name == MODEL_PRIORITY[1]
+    assert manager.api_key_index == 0
+    assert manager._is_limited(MODEL_PRIORITY[0], 0)
+    assert manager.quota(MODEL_PRIORITY[1], 0).day_used == 17
+
+
+def test_stale_snapshot_keeps_live_limits_but_not_model(manager):
+    assert not manager.restore(snapshot(saved_ago=7 * 3600, open_for=600))
+    assert manager.current_model is None
+    assert manager._is_limited(MODEL_PRIORITY[0], 0)
+    assert manager.breaker(MODEL_PRIORITY[0], 0).failures == 2
+    assert manager.quota(MODEL_PRIORITY[1], 0).day_used == 17
+    assert manager.quota(MODEL_PRIORITY[2], 0).day_used == 0
+
+
+def test_stale_snapshot_drops_expired_pauses(manager):
+    manager.restore(snapshot(saved_ago=7 * 3600, open_for=-60))
+    assert not manager._is_limited(MODEL_PRIORITY[0], 0)
+
+
+def test_snapshot_for_other_keys_is_ignored(manager):
+    data = snapshot(saved_ago=60, open_for=600)
+    data["keys"] = ["0" * 12]
+    assert not manager.restore(data)
+    assert not manager._is_limited(MODEL_PRIORITY[0], 0)
@@ -0,0 +1,78 @@
+import pytest
+
+import medical_bot_main as bot_main
+from medical_bot_main import PairBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot_main.time, "time", lambda: now[0])
+    return now
+
+
+def test_new_breaker_is_closed(clock):
+    breaker = PairBreaker()
+    assert breaker.available()
+    assert breaker.state == "closed"
+
+
+def test_failure_opens_until_cooldown_passes(clock):
+    breaker = PairBreaker()
+    breaker.record_failure(60)
+    assert breaker.state == "open"
+    assert not breaker.available()
+
+    clock[0] += 61
+    assert breaker.available()
+    assert breaker.state == "half_open"
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = PairBreaker()
+    breaker.record_failure(60)
+    clock[0] += 61
+
+    assert breaker.available()
+    breaker.begin()
+    assert not breaker.available()
+
+    breaker.release()
+    assert breaker.available()
+
+
+def test_failed_trial_doubles_the_pause(clock):
+    breaker = PairBreaker()
+    breaker.record_failure(60)
+    clock[0] += 61
+    breaker.available()
+    breaker.begin()
+    breaker.record_failure(60)
+
+    assert breaker.state == "open"
+    assert breaker.open_until == pytest.approx(clock[0] + 120)
+
+
+def test_success_closes_and_resets(clock):
+    breaker = PairBreaker()
+    breaker.record_failure(60)
+    clock[0] += 61
+    breaker.available()
+    breaker.begin()
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    assert breaker.available()
+
+
+def test_per_day_pause_is_not_doubled(clock):
+    breaker = PairBreaker()
+    breaker.record_failure(60)
+    clock[0] += 61
+    breaker.available()
+    breaker.begin()
+    breaker.record_failure(80000, per_day=True)
+
+    assert breaker.state == "open"
+    assert breaker.open_until == pytest.approx(clock[0] + 80000)
@@ -0,0 +1,49 @@
+from medical_bot_main import open_markdown, split_head, split_message
+
+
+def test_short_text_is_not_split():
+    assert split_head("короткий текст", 100) == ("короткий текст", "")
+
+
+def test_cut_prefers_paragraph_boundary():
+    text = "а" * 60 + "\n\n" + "б" * 60
+    head, rest = split_head(text, 100)
+    assert head == "а" * 60
+    assert rest == "б" * 60
+
+
+def test_paragraph_without_breaks_is_hard_cut():
+    parts = split_message("я" * 9000)
+    assert all(len(part) <= 4096 for part in parts)
+    assert "".join(parts) == "я" * 9000
+
+
+def test_open_bold_is_closed_and_reopened():
+    text = "*" + "слово " * 40
+    head, rest = split_head(text, 100)
+    assert open_markdown(head) == []
+    assert rest.startswith("*")
+
+
+def test_code_fence_is_closed_and_reopened():
+    text = "```\n" + "x = 1\n" * 40 + "```"
+    head, rest = split_head(text, 100)
+    assert head.endswith("\n```")
+    assert rest.startswith("```\n")
+    assert open_markdown(head) == []
+    assert open_markdown(rest) == []
+
+
+def test_list_bullets_are_not_markup():
+    text = "".join(f"* пункт {i} списка с *важным* текстом\n" for i in range(300))
+    for part in split_message(text):
+        assert open_markdown(part) == []
+        assert not part.endswith("*")
+
+
+def test_open_markdown_ignores_non_markup():
+    assert open_markdown("  * пункт") == []
+    assert open_markdown("a * b") == []
+    assert open_markdown("snake_case") == []
+    assert open_markdown("*Источники:*\n") == []
+    assert open_markdown("*жирный ещё") == ["*"]
@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import medical_bot_main as bot_main
+from medical_bot_main import MemoryStateBackend, StateBackend, UserStateStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_state_backend_is_abstract():
+    with pytest.raises(TypeError):
+        StateBackend()
+
+
+def test_state_round_trips_through_backend():
+    async def scenario():
+        backend = MemoryStateBackend()
+        store = UserStateStore(max_users=10, idle_ttl=3600, backend=backend)
+        state = await store.get(1)
+        state.mode = "medicine_gynecology"
+        state.conversation_history.append({"role": "user", "parts": ["вопрос"]})
+        state.summary = "сводка"
+        await store.flush()
+
+        fresh = UserStateStore(max_users=10, idle_ttl=3600, backend=backend)
+        return await fresh.get(1)
+
+    loaded = run(scenario())
+    assert loaded.mode == "medicine_gynecology"
+    assert loaded.conversation_history == [{"role": "user", "parts": ["вопрос"]}]
+    assert loaded.summary == "сводка"
+
+
+def test_backend_keeps_copies_not_live_objects():
+    async def scenario():
+        backend = MemoryStateBackend()
+        store = UserStateStore(max_users=10, idle_ttl=3600, backend=backend)
+        state = await store.get(1)
+        await store.flush()
+        state.conversation_history.append({"role": "user", "parts": ["после записи"]})
+        return backend.records[1]
+
+    assert run(scenario())["conversation_history"] == []
+
+
+def test_evicted_unflushed_state_is_not_lost():
+    async def scenario():
+        store = UserStateStore(max_users=2, idle_ttl=3600, backend=MemoryStateBackend())
+        first = await store.get(1)
+        first.summary = "ещё не записано"
+        await store.get(2)
+        await store.get(3)  # вытесняет пользователя 1 до записи
+        assert 1 not in store.states
+        return await store.get(1), store.evicted
+
+    state, evicted = run(scenario())
+    assert state.summary == "ещё не записано"
+    assert evicted >= 1
+
+
+def test_failed_flush_is_retried():
+    class FlakyBackend(MemoryStateBackend):
+        def __init__(self):
+            super().__init__()
+            self.fail = True
+
+        async def save_many(self, records):
+            if self.fail:
+                self.fail = False
+                raise OSError("disk full")
+            await super().save_many(records)
+
+    async def scenario():
+        backend = FlakyBackend()
+        store = UserStateStore(max_users=10, idle_ttl=3600, backend=backend)
+        await store.get(1)
+        await store.flush()
+        assert 1 in store.dirty and not backend.records
+        await store.flush()
+        return backend, store
+
+    backend, store = run(scenario())
+    assert 1 in backend.records
+    assert not store.dirty
+
+
+def test_sweep_unloads_idle_users():
+    async def scenario():
+        store = UserStateStore(max_users=10, idle_ttl=60, backend=MemoryStateBackend())
+        idle = await store.get(1)
+        await store.get(2)
+        idle.last_activity = datetime.now(bot_main.MSK_TZ) - timedelta(seconds=120)
+        store.states.move_to_end(1, last=False)
+        return store.sweep(), list(store.states)
+
+    removed, remaining = run(scenario())
+    assert removed == 1
+    assert remaining == [2]